@@ -1,9 +1,13 @@
 # Reference from https://github.com/triton-inference-server/vllm_backend
 
 import asyncio
+import collections
+import dataclasses
 import json
 import os
 import threading
+import time
+import typing
 from typing import AsyncGenerator
 
 import numpy as np
@@ -16,6 +20,27 @@ import huggingface_hub
 
 # Environment and configuration setup
 _VLLM_ENGINE_ARGS_FILENAME = "vllm_engine_args.json"
+# Engine arguments used unless the environment, config.pbtxt or vllm_engine_args.json set them
+_DEFAULT_ENGINE_ARGS = {
+    "model": "meta-llama/Llama-2-7b-chat-hf",
+    "disable_log_requests": True,
+    "gpu_memory_utilization": 0.8,
+    "max_model_len": 4096,
+}
+# How often a saturated backend re-checks the engine before taking the next request
+_BACKPRESSURE_POLL_INTERVAL_S = 0.01
+# How often a running request checks whether its client cancelled it
+_CANCELLATION_POLL_INTERVAL_S = 0.2
+# How often the custom metrics are flushed to Triton
+_METRICS_FLUSH_INTERVAL_S = 1.0
+# Environment variables read as engine arguments, with the argument each one sets
+_ENV_ENGINE_ARGS = {
+    "model_name": "model",
+    "tensor_parallel_size": "tensor_parallel_size",
+    "gpu_memory_utilization": "gpu_memory_utilization",
+    "dtype": "dtype",
+    "max_model_len": "max_model_len",
+}
 huggingface_hub.login(token=os.environ.get("HUGGING_FACE_TOKEN", ""))
 
 
@@ -45,17 +70,8 @@ class TritonPythonModel:
         gpu_id = args.get("model_instance_device_id", "1")
         os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id
 
-        vllm_engine_config = {
-            "model": os.environ.get("model_name", "meta-llama/Llama-2-7b-chat-hf"),
-            "disable_log_requests": "true",
-            "tensor_parallel_size": int(os.environ.get("tensor_parallel_size", 1)),
-            "gpu_memory_utilization": float(
-                os.environ.get("gpu_memory_utilization", "0.8")
-            ),
-            "dtype": os.environ.get("dtype", "auto"),
-            "max_model_len": int(os.environ.get("max_model_len", 4096)),
-            "enforce_eager": True,
-        }
+        vllm_engine_config = self.load_engine_args(engine_args_filepath)
+        self.logger.log_info(f"vLLM engine args: {vllm_engine_config}")
 
         # Create an AsyncLLMEngine from the config from JSON
         self.llm_engine = AsyncLLMEngine.from_engine_args(
@@ -68,6 +84,20 @@ class TritonPythonModel:
         # Counter to keep track of ongoing request counts
         self.ongoing_request_count = 0
 
+        self.init_metrics(args)
+
+        # Backpressure: execute() holds new requests while this many requests wait for the
+        # engine, or while less than this fraction of the KV cache is free ("0" disables).
+        self.max_waiting_requests = int(
+            self.get_parameter("max_waiting_requests", "16")
+        )
+        self.min_free_kv_cache_fraction = float(
+            self.get_parameter("min_free_kv_cache_fraction", "0.05")
+        )
+        # Requests handed to the engine loop that have not produced output yet
+        self.queued_request_count = 0
+        self._queued_lock = threading.Lock()
+
         # Starting asyncio event loop to process the received requests asynchronously.
         self._loop = asyncio.get_event_loop()
         self._loop_thread = threading.Thread(
@@ -76,6 +106,219 @@ class TritonPythonModel:
         self._shutdown_event = asyncio.Event()
         self._loop_thread.start()
 
+        # Every metric update is an IPC call to Triton, so they are made from a thread of
+        # their own. Requests only queue their measurements, once, when they finish.
+        self.completed_requests = collections.deque()
+        self._metrics_thread = threading.Thread(target=self.metrics_loop, daemon=True)
+        self._metrics_thread.start()
+
+    def init_metrics(self, args):
+        """
+        Registers the backend's custom metrics, exported on Triton's metrics
+        endpoint with model and version labels. Latencies are histograms where
+        this Triton version supports custom histograms and <name>_sum and
+        <name>_count counters otherwise, so averages can be taken either way.
+        Latency metrics are observed with a list of values at a time.
+        """
+        labels = {"model": self.model_config["name"], "version": args["model_version"]}
+        self.metric_families = {}
+
+        def family(name, description, kind):
+            self.metric_families[name] = pb_utils.MetricFamily(
+                name=name, description=description, kind=kind
+            )
+            return self.metric_families[name]
+
+        def counter(name, description):
+            kind = pb_utils.MetricFamily.COUNTER
+            return family(name, description, kind).Metric(labels=labels)
+
+        def gauge(name, description):
+            kind = pb_utils.MetricFamily.GAUGE
+            return family(name, description, kind).Metric(labels=labels)
+
+        def histogram(name, description, buckets):
+            if hasattr(pb_utils.MetricFamily, "HISTOGRAM"):
+                kind = pb_utils.MetricFamily.HISTOGRAM
+                metric = family(name, description, kind).Metric(
+                    labels=labels, buckets=buckets
+                )
+
+                def observe(values):
+                    for value in values:
+                        metric.observe(value)
+
+                return observe
+            total = counter(f"{name}_sum", description)
+            count = counter(f"{name}_count", description)
+
+            def observe(values):
+                if values:
+                    total.increment(sum(values))
+                    count.increment(len(values))
+
+            return observe
+
+        self.requests_cancelled = counter(
+            "vllm_requests_cancelled_total", "Requests cancelled by their client"
+        )
+        self.requests_aborted = counter(
+            "vllm_requests_aborted_total",
+            "Engine requests aborted after a cancellation, freeing their KV cache",
+        )
+        self.prompt_tokens = counter(
+            "vllm_prompt_tokens_total", "Prompt tokens processed by the engine"
+        )
+        self.generation_tokens = counter(
+            "vllm_generation_tokens_total", "Tokens generated by the engine"
+        )
+        self.observe_time_to_first_token = histogram(
+            "vllm_time_to_first_token_seconds",
+            "Time from a request reaching the backend to its first token",
+            [0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60],
+        )
+        self.observe_inter_token_latency = histogram(
+            "vllm_inter_token_latency_seconds",
+            "Mean time between consecutive generated tokens of a request",
+            [0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1],
+        )
+        self.observe_output_tokens_per_second = histogram(
+            "vllm_output_tokens_per_second",
+            "Tokens per second a request generated after its first token",
+            [5, 10, 20, 30, 40, 50, 60, 80, 100, 150, 200],
+        )
+        self.kv_cache_usage = gauge(
+            "vllm_kv_cache_usage_ratio", "Fraction of the GPU KV cache in use"
+        )
+        self.requests_waiting = gauge(
+            "vllm_num_requests_waiting", "Requests waiting for the engine"
+        )
+        self.requests_running = gauge(
+            "vllm_num_requests_running", "Requests running in the engine"
+        )
+
+    def load_engine_args(self, engine_args_filepath):
+        """
+        Builds the vLLM engine arguments from, in increasing order of precedence:
+        the built-in defaults, the environment, the parameters in config.pbtxt
+        (model_name sets model) and vllm_engine_args.json in the model repository.
+        config.pbtxt parameters that are not engine arguments are left to the backend.
+        """
+        field_types = {
+            field.name: field.type for field in dataclasses.fields(AsyncEngineArgs)
+        }
+        engine_args = dict(_DEFAULT_ENGINE_ARGS)
+        for env_name, key in _ENV_ENGINE_ARGS.items():
+            if env_name in os.environ:
+                engine_args[key] = os.environ[env_name]
+        for key, value in self.model_config.get("parameters", {}).items():
+            key = "model" if key == "model_name" else key
+            if key in field_types:
+                engine_args[key] = value["string_value"]
+        if os.path.isfile(engine_args_filepath):
+            with open(engine_args_filepath) as file:
+                engine_args.update(json.load(file))
+
+        # Values from the environment and config.pbtxt are strings
+        for key, value in engine_args.items():
+            if isinstance(value, str) and key in field_types:
+                engine_args[key] = self.parse_engine_arg(value, field_types[key])
+        return engine_args
+
+    def get_parameter(self, key, default):
+        parameter = self.model_config.get("parameters", {}).get(key)
+        return parameter["string_value"] if parameter else default
+
+    @staticmethod
+    def parse_engine_arg(value, field_type):
+        if typing.get_origin(field_type) is typing.Union:
+            field_type = next(
+                t for t in typing.get_args(field_type) if t is not type(None)
+            )
+        if field_type is bool:
+            return value.lower() in ("true", "1", "yes")
+        if field_type in (int, float):
+            return field_type(value)
+        return value
+
+    def engine_load(self):
+        """
+        Returns the number of requests waiting for and running in the engine and
+        the free fraction of the GPU KV cache, read from the engine's scheduler(s).
+        Requests that were handed to the engine loop but are not in the scheduler
+        yet count as waiting.
+        """
+        llm_engine = self.llm_engine.engine
+        schedulers = llm_engine.scheduler
+        if not isinstance(schedulers, list):
+            schedulers = [schedulers]
+        waiting = sum(len(scheduler.waiting) for scheduler in schedulers)
+        running = sum(len(scheduler.running) for scheduler in schedulers)
+        total_blocks = llm_engine.cache_config.num_gpu_blocks * len(schedulers)
+        free_blocks = sum(
+            scheduler.block_manager.get_num_free_gpu_blocks() for scheduler in schedulers
+        )
+        waiting = max(waiting, self.queued_request_count)
+        return waiting, running, free_blocks / total_blocks
+
+    def record_load(self):
+        waiting, running, free_kv_cache = self.engine_load()
+        self.requests_waiting.set(waiting)
+        self.requests_running.set(running)
+        self.kv_cache_usage.set(1 - free_kv_cache)
+
+    def metrics_loop(self):
+        while not self._shutdown_event.is_set():
+            time.sleep(_METRICS_FLUSH_INTERVAL_S)
+            try:
+                self.flush_metrics()
+            except Exception as e:
+                self.logger.log_warn(f"Failed to flush metrics: {e}")
+
+    def flush_metrics(self):
+        """
+        Records the requests that finished since the last flush and samples the
+        engine load. Each entry of completed_requests is a (time to first token,
+        prompt tokens, generated tokens, tokens decoded after the first one, seconds
+        from the first to the last token) tuple.
+        """
+        completed = []
+        while self.completed_requests:
+            completed.append(self.completed_requests.popleft())
+        if completed:
+            self.observe_time_to_first_token([entry[0] for entry in completed])
+            self.prompt_tokens.increment(sum(entry[1] for entry in completed))
+            self.generation_tokens.increment(sum(entry[2] for entry in completed))
+            # Rates need at least two tokens generated at different times
+            decodes = [entry[3:] for entry in completed if entry[3] > 0 and entry[4] > 0]
+            self.observe_inter_token_latency([t / tokens for tokens, t in decodes])
+            self.observe_output_tokens_per_second([tokens / t for tokens, t in decodes])
+        self.record_load()
+
+    def is_saturated(self):
+        waiting, _, free_kv_cache = self.engine_load()
+        return (
+            0 < self.max_waiting_requests <= waiting
+            or free_kv_cache < self.min_free_kv_cache_fraction
+        )
+
+    def request_started(self):
+        with self._queued_lock:
+            self.queued_request_count -= 1
+
+    async def watch_cancellation(self, response_sender, request_id):
+        """
+        Aborts the engine request once its client cancels it or its stream times
+        out, so it stops taking decode steps and its KV cache blocks are released.
+        Polling keeps the check off the per-token path.
+        """
+        while not response_sender.is_cancelled():
+            await asyncio.sleep(_CANCELLATION_POLL_INTERVAL_S)
+        self.requests_cancelled.increment(1)
+        self.logger.log_info(f"Cancelling request {request_id}")
+        await self.llm_engine.abort(request_id)
+        self.requests_aborted.increment(1)
+
     def create_task(self, coro):
         """
         The create_task method schedules asynchronous tasks on the
@@ -144,28 +387,80 @@ class TritonPythonModel:
 
         return params_dict
 
-    def create_response(self, vllm_output):
+    def create_response(self, vllm_output, delta_state=None, output_names=()):
         """
         Responses are created using the create_response
         method and sent back to Triton.
+
+        Streamed responses (delta_state given) carry only the text generated since the
+        previous response, non-streamed ones the prompt and the full text. TOKEN_IDS, the
+        token IDs of the first completion, is only filled in when the client requests it.
+        The response for the finished request also carries the finish reasons and the
+        prompt and completion token counts.
         """
-        prompt = vllm_output.prompt
-        text_outputs = [
-            (prompt + output.text).encode("utf-8") for output in vllm_output.outputs
+        if delta_state is None:
+            texts = [vllm_output.prompt + output.text for output in vllm_output.outputs]
+            token_ids = vllm_output.outputs[0].token_ids
+        else:
+            texts = []
+            for i, output in enumerate(vllm_output.outputs):
+                texts.append(output.text[delta_state.get(i, 0) :])
+                delta_state[i] = len(output.text)
+            first = vllm_output.outputs[0]
+            token_ids = first.token_ids[delta_state.get("token_ids", 0) :]
+            delta_state["token_ids"] = len(first.token_ids)
+
+        output_tensors = [
+            pb_utils.Tensor(
+                "TEXT",
+                np.asarray(
+                    [text.encode("utf-8") for text in texts], dtype=self.output_dtype
+                ),
+            )
         ]
-        triton_output_tensor = pb_utils.Tensor(
-            "TEXT", np.asarray(text_outputs, dtype=self.output_dtype)
-        )
-        return pb_utils.InferenceResponse(output_tensors=[triton_output_tensor])
-
-    async def generate(self, request):
+        if "TOKEN_IDS" in output_names:
+            output_tensors.append(
+                pb_utils.Tensor("TOKEN_IDS", np.asarray(token_ids, dtype=np.int64))
+            )
+        if vllm_output.finished:
+            finish_reasons = [
+                str(output.finish_reason).encode("utf-8")
+                for output in vllm_output.outputs
+            ]
+            completion_tokens = sum(
+                len(output.token_ids) for output in vllm_output.outputs
+            )
+            output_tensors += [
+                pb_utils.Tensor(
+                    "FINISH_REASON", np.asarray(finish_reasons, dtype=np.object_)
+                ),
+                pb_utils.Tensor(
+                    "PROMPT_TOKENS",
+                    np.asarray([len(vllm_output.prompt_token_ids)], dtype=np.int32),
+                ),
+                pb_utils.Tensor(
+                    "COMPLETION_TOKENS",
+                    np.asarray([completion_tokens], dtype=np.int32),
+                ),
+            ]
+        return pb_utils.InferenceResponse(output_tensors=output_tensors)
+
+    async def generate(self, request, arrival_time):
         """
         Generate method forwards the input prompt to the
         vLLM engine and collects the output.
+        arrival_time is when execute() received the request.
         """
         response_sender = request.get_response_sender()
         self.ongoing_request_count += 1
+        started = False
+        cancellation_watcher = None
         try:
+            # Requests held back by backpressure may have been cancelled meanwhile
+            if request.is_cancelled():
+                self.requests_cancelled.increment(1)
+                return
+
             request_id = random_uuid()
             prompt = pb_utils.get_input_tensor_by_name(request, "PROMPT").as_numpy()[0]
             if isinstance(prompt, bytes):
@@ -182,18 +477,50 @@ class TritonPythonModel:
 
             sampling_params_dict = self.get_sampling_params_dict(parameters)
             sampling_params = SamplingParams(**sampling_params_dict)
+            output_names = request.requested_output_names()
 
+            # Characters and token IDs already streamed, so every response carries only new output.
+            delta_state = {}
             last_output = None
+            cancellation_watcher = asyncio.create_task(
+                self.watch_cancellation(response_sender, request_id)
+            )
+            generated_tokens = 0
             async for output in self.llm_engine.generate(
                 prompt, sampling_params, request_id
             ):
+                now = time.monotonic()
+                num_tokens = len(output.outputs[0].token_ids)
+                if not started:
+                    started = True
+                    self.request_started()
+                    first_token_time = last_token_time = now
+                elif num_tokens > generated_tokens:
+                    last_token_time = now
+                generated_tokens = num_tokens
                 if stream:
-                    response_sender.send(self.create_response(output))
-                else:
-                    last_output = output
-
+                    response = self.create_response(output, delta_state, output_names)
+                    response_sender.send(response)
+                last_output = output
+
+            if last_output is not None:
+                self.completed_requests.append(
+                    (
+                        first_token_time - arrival_time,
+                        len(last_output.prompt_token_ids),
+                        sum(len(output.token_ids) for output in last_output.outputs),
+                        generated_tokens - 1,
+                        last_token_time - first_token_time,
+                    )
+                )
+
+            if cancellation_watcher.done():
+                # Aborted: the client is no longer waiting for the rest
+                return
             if not stream:
-                response_sender.send(self.create_response(last_output))
+                response_sender.send(
+                    self.create_response(last_output, output_names=output_names)
+                )
 
         except Exception as e:
             self.logger.log_info(f"Error generating stream: {e}")
@@ -207,21 +534,30 @@ class TritonPythonModel:
             response_sender.send(response)
             raise e
         finally:
+            if cancellation_watcher is not None:
+                cancellation_watcher.cancel()
             response_sender.send(flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL)
+            if not started:
+                self.request_started()
             self.ongoing_request_count -= 1
 
     def execute(self, requests):
         """
         Triton core issues requests to the backend via this method.
 
-        When this method returns, new requests can be issued to the backend. Blocking
-        this function would prevent the backend from pulling additional requests from
-        Triton into the vLLM engine. This can be done if the kv cache within vLLM engine
-        is too loaded.
-        We are pushing all the requests on mistral7b and let it handle the full traffic.
+        When this method returns, new requests can be issued to the backend. While
+        the engine is saturated (too many waiting requests or too little free KV
+        cache) this method blocks before handing over the next request, so the
+        backlog stays in Triton's queue, where the queue duration metrics and the
+        autoscaler see it, instead of hiding inside vLLM.
         """
+        arrival_time = time.monotonic()
         for request in requests:
-            self.create_task(self.generate(request))
+            while self.is_saturated() and not self._shutdown_event.is_set():
+                time.sleep(_BACKPRESSURE_POLL_INTERVAL_S)
+            with self._queued_lock:
+                self.queued_request_count += 1
+            self.create_task(self.generate(request, arrival_time))
         return None
 
     def finalize(self):
@@ -233,3 +569,6 @@ class TritonPythonModel:
         if self._loop_thread is not None:
             self._loop_thread.join()
             self._loop_thread = None
+        if self._metrics_thread is not None:
+            self._metrics_thread.join()
+            self._metrics_thread = None
@@ -10,10 +10,6 @@ import tritonclient.grpc.aio as grpcclient
 from tritonclient.utils import *
 
 
-def count_tokens(text):
-    return len(text.split())
-
-
 def create_request(prompt, stream, request_id, sampling_parameters, model_name, send_parameters_as_tensor=True):
     inputs = []
     prompt_data = np.array([prompt.encode("utf-8")], dtype=np.object_)
@@ -36,6 +32,9 @@ def create_request(prompt, stream, request_id, sampling_parameters, model_name,
 
     outputs = []
     outputs.append(grpcclient.InferRequestedOutput("TEXT"))
+    # Sent with the final response of every request
+    outputs.append(grpcclient.InferRequestedOutput("FINISH_REASON"))
+    outputs.append(grpcclient.InferRequestedOutput("COMPLETION_TOKENS"))
 
     return {
         "model_name": model_name,
@@ -65,7 +64,7 @@ async def main(FLAGS):
                 for iter in range(FLAGS.iterations):
                     for i, prompt in enumerate(prompts):
                         prompt_id = FLAGS.offset + (len(prompts) * iter) + i
-                        results_dict[str(prompt_id)] = []
+                        results_dict[str(prompt_id)] = {"Prompt": prompt, "Response": "", "Response Time": 0, "Tokens": 0}
                         SYSTEM_PROMPT = """<<SYS>>\nKeep short answers of no more than 100 sentences.\n<</SYS>>\n\n"""
                         prompt = "<s>[INST]" + SYSTEM_PROMPT + prompt + "[/INST]"
                         yield create_request(
@@ -87,15 +86,16 @@ async def main(FLAGS):
                 if error:
                     print(f"Encountered error while processing: {error}")
                 else:
-                    output = result.as_numpy("TEXT")
-                    for i in output:
-                        debug = {
-                            "Prompt": prompts[int(result.get_response().id)],
-                            "Response Time": end_time - start_time,
-                            "Tokens": count_tokens(i.decode('utf-8')),
-                            "Response": i.decode('utf-8'),
-                        }
-                        results_dict[result.get_response().id] = debug
+                    # Streamed responses carry only the new text, so append it to what came before
+                    result_entry = results_dict[result.get_response().id]
+                    for i in result.as_numpy("TEXT"):
+                        result_entry["Response"] += i.decode('utf-8')
+                    result_entry["Response Time"] = end_time - start_time
+                    completion_tokens = result.as_numpy("COMPLETION_TOKENS")
+                    if completion_tokens is None:
+                        # Not the final response yet
+                        continue
+                    result_entry["Tokens"] = int(completion_tokens[0])
 
                     duration = (end_time - start_time)  # Calculate the duration in seconds
                     total_time_sec += (end_time - start_time)  # Add duration to total time in seconds
@@ -14,6 +14,8 @@ logger = logging.getLogger(__name__)
 # Constants for model endpoint and service name
 model_endpoint = os.getenv("MODEL_ENDPOINT", "/vllm")
 service_name = os.getenv("SERVICE_NAME", "http://localhost:8000")
+# Seconds to wait for a response; also sent to the server as the request deadline
+request_timeout = 180
 
 # Function to count tokens in a response
 def count_tokens(text):
@@ -29,7 +31,8 @@ async def generate_text(session, prompt):
         "temperature": 0.01,  # Adjusted for balanced responses
         "top_p": 1,  # Adjusted for balanced responses
         "top_k": 20,  # Increased for more diversity in responses
-        "stop": None
+        "stop": None,
+        "timeout": request_timeout  # The server aborts the request once we stop waiting for it
     }
     # Create the URL for the inference
     url = f"{service_name}{model_endpoint}"
@@ -39,7 +42,7 @@ async def generate_text(session, prompt):
         start_time = time.perf_counter()
 
         # Send the request to the model service
-        async with session.post(url, json=payload, timeout=180) as response:
+        async with session.post(url, json=payload, timeout=request_timeout) as response:
             # Measure the end time for the inference
             end_time = time.perf_counter()
             latency = end_time - start_time
@@ -71,32 +74,6 @@ async def generate_text(session, prompt):
         logger.error(f"Request exception: {str(e)}")
         return None, None, 0
 
-# Function to warm up the model
-async def warmup(session):
-    """Warm up the model to reduce cold start latency."""
-    prompt = "Warmup"
-    payload = {
-        "prompt": prompt,
-        "stream": False,
-        "max_tokens": 1,
-        "temperature": 0.7,
-        "top_p": 0.9,
-        "top_k": 50,
-        "stop": None
-    }
-    url = f"{service_name}{model_endpoint}"
-
-    try:
-        # Send the warm-up request to the model service
-        async with session.post(url, json=payload, timeout=180) as response:
-            if response.status == 200:
-                logger.info("Warm-up successful")
-            else:
-                logger.error(f"Failed to warm up model. Status code: {response.status}")
-                logger.error(f"Error message: {await response.text()}")
-    except aiohttp.ClientError as e:
-        logger.error(f"Warm-up request exception: {str(e)}")
-
 # Function to read prompts from a file
 def read_prompts(file_path):
     with open(file_path, 'r') as file:
@@ -133,9 +110,6 @@ async def main():
     min_latency = float('inf')
 
     async with aiohttp.ClientSession() as session:
-        # Warm up the model
-        await warmup(session)
-
         tasks = [generate_text(session, prompt) for prompt in prompts]
         responses = await asyncio.gather(*tasks)
 
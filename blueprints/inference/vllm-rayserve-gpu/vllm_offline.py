@@ -0,0 +1,126 @@
+"""
+Offline batch inference with Ray Data.
+
+Runs the vLLM engine configuration of VLLMDeployment (vllm_serve.engine_kwargs) in a pool of GPU
+actors and streams prompts from JSONL or Parquet files through it with map_batches, writing the
+completions to Parquet. Nothing goes through the HTTP serving path, and the engine always sees a
+full batch, so large evaluation and labelling jobs run at the engine's maximum tokens/s.
+
+Every input row is keyed by its "id" column, or by its file and prompt when it has none. Output
+files are written as blocks complete, and re-running the job against the same --output skips rows
+that already have a result, so an interrupted job resumes where it stopped.
+
+    python vllm_offline.py --input s3://my-bucket/prompts/ --output s3://my-bucket/completions/ --num-actors 4
+"""
+import argparse
+import hashlib
+import logging
+import os
+from typing import Dict, Set
+
+import numpy as np
+import pyarrow.fs
+import pyarrow.parquet
+import ray
+
+from vllm_serve import MODEL_REVISION, WEIGHTS_DIR, engine_kwargs
+from weight_staging import stage_weights
+
+logger = logging.getLogger("ray.data")
+
+
+class VLLMPredictor:
+    """Generates completions for a batch of prompts on one GPU."""
+
+    def __init__(self, sampling: dict):
+        from huggingface_hub import login
+        from vllm import LLM, SamplingParams
+
+        hf_token = os.getenv("HUGGING_FACE_HUB_TOKEN")
+        model = None
+        if WEIGHTS_DIR:
+            model, _ = stage_weights(os.getenv("MODEL_ID", "mistralai/Mistral-7B-Instruct-v0.2"), WEIGHTS_DIR,
+                                     MODEL_REVISION, hf_token)
+        elif hf_token:
+            login(token=hf_token)
+        kwargs = engine_kwargs(model=model)
+        if model:
+            kwargs["load_format"] = "safetensors"
+        # The offline engine tokenizes a whole batch up front, a Ray tokenizer pool only adds hops.
+        kwargs.pop("tokenizer_pool_size")
+        kwargs.pop("tokenizer_pool_type")
+        self.llm = LLM(**kwargs)
+        self.sampling_params = SamplingParams(**sampling)
+
+    def __call__(self, batch: Dict[str, np.ndarray]) -> Dict[str, list]:
+        outputs = self.llm.generate(list(batch["prompt"]), self.sampling_params, use_tqdm=False)
+        return {
+            "id": list(batch["id"]),
+            "prompt": list(batch["prompt"]),
+            "generated_text": [output.outputs[0].text for output in outputs],
+            "finish_reason": [output.outputs[0].finish_reason for output in outputs],
+            "prompt_tokens": [len(output.prompt_token_ids) for output in outputs],
+            "generated_tokens": [len(output.outputs[0].token_ids) for output in outputs],
+        }
+
+
+def assign_ids(batch: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    if "id" in batch:
+        ids = [str(row_id) for row_id in batch["id"]]
+    else:
+        ids = [
+            hashlib.blake2b(f"{path}\0{prompt}".encode("utf-8"), digest_size=16).hexdigest()
+            for path, prompt in zip(batch["path"], batch["prompt"])
+        ]
+    return {"id": np.array(ids, dtype=object), "prompt": batch["prompt"]}
+
+
+def completed_ids(output: str) -> Set[str]:
+    """IDs of the rows that already have a result under output."""
+    filesystem, path = pyarrow.fs.FileSystem.from_uri(output)
+    if filesystem.get_file_info(path).type == pyarrow.fs.FileType.NotFound:
+        return set()
+    table = pyarrow.parquet.read_table(path, columns=["id"], filesystem=filesystem)
+    return set(table.column("id").to_pylist())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline vLLM batch inference with Ray Data")
+    parser.add_argument("--input", required=True, help="JSONL or Parquet file or directory with a 'prompt' column")
+    parser.add_argument("--output", required=True, help="Parquet output directory, also the checkpoint")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], help="Input format (default: from the extension)")
+    parser.add_argument("--num-actors", type=int, default=1, help="GPU actors, one engine each")
+    parser.add_argument("--batch-size", type=int, default=512, help="Prompts per engine batch")
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--top-p", type=float, default=1.0)
+    args = parser.parse_args()
+
+    input_format = args.format or ("parquet" if args.input.rstrip("/").endswith(".parquet") else "jsonl")
+    read = ray.data.read_parquet if input_format == "parquet" else ray.data.read_json
+    ds = read(args.input, include_paths=True)
+    columns = ["prompt", "path"] + (["id"] if "id" in ds.schema().names else [])
+    ds = ds.select_columns(columns).map_batches(assign_ids, batch_format="numpy")
+
+    done = completed_ids(args.output)
+    if done:
+        logger.info(f"Resuming: skipping {len(done)} rows that already have a result")
+        ds = ds.filter(lambda row: row["id"] not in done)
+
+    ds = ds.map_batches(
+        VLLMPredictor,
+        fn_constructor_kwargs={"sampling": {
+            "max_tokens": args.max_tokens,
+            "temperature": args.temperature,
+            "top_p": args.top_p,
+        }},
+        concurrency=args.num_actors,
+        num_gpus=1,
+        batch_size=args.batch_size,
+        batch_format="numpy",
+    )
+    ds.write_parquet(args.output)
+
+
+if __name__ == "__main__":
+    main()
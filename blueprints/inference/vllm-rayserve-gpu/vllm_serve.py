@@ -1,76 +1,1287 @@
+import asyncio
+import gc
+import hashlib
+import heapq
+import inspect
+import itertools
 import json
-from typing import AsyncGenerator
-from fastapi import BackgroundTasks
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncGenerator, Callable, Dict, List, Optional, Tuple
 from starlette.requests import Request
 from starlette.responses import StreamingResponse, Response, JSONResponse
 from vllm.engine.arg_utils import AsyncEngineArgs
 from vllm.engine.async_llm_engine import AsyncLLMEngine
+from vllm.lora.request import LoRARequest
 from vllm.sampling_params import SamplingParams
 from vllm.utils import random_uuid
+import msgpack
+import ray
 from ray import serve
+from ray.serve import metrics
+from ray.serve.handle import DeploymentHandle
 import os
 import logging
 
 from huggingface_hub import login
 
+from weight_staging import stage_weights, staged_path, verify
+
+try:
+    # vLLM >= 0.6.1 can return only the newly generated text and tokens on every engine step.
+    from vllm.sampling_params import RequestOutputKind
+except ImportError:
+    RequestOutputKind = None
+
 # Environment and configuration setup
 logger = logging.getLogger("ray.serve")
 
-@serve.deployment(name="mistral-deployment", route_prefix="/vllm",
+# Stage the model's weights here (node-local NVMe or a shared filesystem) and load them from disk
+# instead of the Hugging Face Hub. Unset to load straight from the Hub.
+WEIGHTS_DIR = os.getenv("WEIGHTS_DIR")
+MODEL_REVISION = os.getenv("MODEL_REVISION", "main")
+
+ROUTE_PREFIX = "/vllm"
+
+# Streamed tokens are coalesced into one chunk until STREAM_CHUNK_TOKENS tokens are buffered
+# or STREAM_CHUNK_INTERVAL_MS milliseconds have passed since the previous chunk.
+STREAM_CHUNK_TOKENS = int(os.getenv("STREAM_CHUNK_TOKENS", "16"))
+STREAM_CHUNK_INTERVAL_S = float(os.getenv("STREAM_CHUNK_INTERVAL_MS", "50")) / 1000
+
+# Requests sampled at or below this temperature are treated as deterministic.
+DETERMINISTIC_MAX_TEMPERATURE = float(os.getenv("DETERMINISTIC_MAX_TEMPERATURE", "0"))
+
+# Admission control: new engine requests are shed with a 503 once the replica's outstanding
+# prompt + max_tokens budget or the current engine queue delay exceeds these limits (0 disables).
+ADMISSION_MAX_TOKENS = int(os.getenv("ADMISSION_MAX_TOKENS", "0"))
+ADMISSION_MAX_QUEUE_S = float(os.getenv("ADMISSION_MAX_QUEUE_S", "0"))
+
+# Tenants are identified by TENANT_HEADER or by an API key listed in TENANTS, a JSON object of
+# {"<tenant>": {"weight": 1, "priority": 0, "prompt_tokens_per_s": 0, "generated_tokens_per_s": 0,
+# "api_keys": []}}; lower priority values are scheduled first by vLLM versions that support
+# request priorities. Requests naming a tenant that is not listed share the "default" tenant and
+# its settings, so clients cannot dodge a rate limit by changing the header. At most
+# SCHEDULER_MAX_RUNNING engine requests run at once (defaults to max_num_seqs); the rest are
+# released across tenants by weighted fair queuing.
+TENANT_HEADER = os.getenv("TENANT_HEADER", "x-tenant-id")
+TENANTS = json.loads(os.getenv("TENANTS", "{}"))
+SCHEDULER_MAX_RUNNING = os.getenv("SCHEDULER_MAX_RUNNING")
+# Request priorities are only honoured by vLLM versions with the "priority" scheduling policy.
+ENGINE_SUPPORTS_PRIORITY = "priority" in inspect.signature(AsyncLLMEngine.generate).parameters
+
+# KV-cache pressure autoscaling: replicas sample the engine's load every LOAD_REPORT_INTERVAL_S
+# and kv_cache_autoscaling_policy keeps the mean KV-cache utilization near the target.
+LOAD_REPORT_INTERVAL_S = float(os.getenv("LOAD_REPORT_INTERVAL_S", "1"))
+KV_CACHE_TARGET_UTILIZATION = float(os.getenv("KV_CACHE_TARGET_UTILIZATION", "0.75"))
+
+# Prefix-affinity routing (the "router" application): the first PREFIX_AFFINITY_TOKENS tokens of
+# each prompt, cut to whole prefix-cache blocks, are hashed into one of PREFIX_AFFINITY_BUCKETS
+# buckets that are routed as Serve multiplexed model IDs. Serve sends a bucket to a replica that
+# already served it, so shared prefixes stay in one replica's prefix cache. The window is short
+# enough to end inside a typical system message, so prompts sharing one, and later turns of a chat,
+# land in the same bucket.
+PREFIX_AFFINITY_BUCKETS = int(os.getenv("PREFIX_AFFINITY_BUCKETS", "256"))
+PREFIX_AFFINITY_BUCKETS_PER_REPLICA = int(os.getenv("PREFIX_AFFINITY_BUCKETS_PER_REPLICA", "64"))
+PREFIX_AFFINITY_TOKENS = int(os.getenv("PREFIX_AFFINITY_TOKENS", "64"))
+# vLLM's default KV-cache block size; the prefix cache only reuses whole blocks.
+PREFIX_CACHE_BLOCK_SIZE = 16
+
+# Context-length pools (the "pooled_router" application): one VLLMDeployment per entry, each with
+# its own max_model_len, max_num_seqs and max_num_batched_tokens. Requests go to the smallest pool
+# that fits prompt + max_tokens, so short chats are not batched under long-context reservations.
+CONTEXT_POOLS = json.loads(os.getenv("CONTEXT_POOLS", json.dumps([
+    {"max_model_len": 8192, "max_num_seqs": 16, "max_num_batched_tokens": 16384},
+    {"max_model_len": 32768, "max_num_seqs": 4, "max_num_batched_tokens": 32768},
+])))
+
+# Server-side limit on how long a request may run before it is aborted (0 disables it). Clients
+# can set a shorter deadline, in seconds, with the TIMEOUT_HEADER header or a "timeout" field.
+REQUEST_TIMEOUT_S = float(os.getenv("REQUEST_TIMEOUT_S", "0"))
+TIMEOUT_HEADER = os.getenv("TIMEOUT_HEADER", "x-request-timeout")
+
+# Speculative decoding: a draft model ID, or "[ngram]" to propose tokens by n-gram lookup in the
+# prompt. Empty disables it. Helps decode latency at low concurrency, costs throughput at high.
+SPECULATIVE_MODEL = os.getenv("SPECULATIVE_MODEL", "")
+NUM_SPECULATIVE_TOKENS = int(os.getenv("NUM_SPECULATIVE_TOKENS", "5"))
+NGRAM_PROMPT_LOOKUP_MAX = int(os.getenv("NGRAM_PROMPT_LOOKUP_MAX", "4"))
+NGRAM_PROMPT_LOOKUP_MIN = int(os.getenv("NGRAM_PROMPT_LOOKUP_MIN", "1"))
+
+# LoRA adapters selected per request with an "adapter" field, loaded lazily from LORA_ADAPTER_DIR/<name>
+# or from the paths in LORA_ADAPTERS ({"name": "/path"}). MAX_LORAS adapters fit in one GPU batch;
+# MAX_CPU_LORAS are kept in the engine's CPU LRU cache.
+LORA_ADAPTER_DIR = os.getenv("LORA_ADAPTER_DIR", "")
+LORA_ADAPTERS = json.loads(os.getenv("LORA_ADAPTERS", "{}"))
+MAX_LORAS = int(os.getenv("MAX_LORAS", "4"))
+MAX_LORA_RANK = int(os.getenv("MAX_LORA_RANK", "16"))
+MAX_CPU_LORAS = int(os.getenv("MAX_CPU_LORAS", "16"))
+
+# Models served by MultiModelDeployment (import_path "vllm_serve:multiplexed_deployment"), selected
+# per request with the serve_multiplexed_model_id header. Each replica keeps up to
+# MULTIPLEX_MODELS_PER_REPLICA of them loaded, each engine taking its share of GPU memory.
+MULTIPLEX_MODELS = json.loads(os.getenv("MULTIPLEX_MODELS", "[]"))
+MULTIPLEX_MODELS_PER_REPLICA = int(os.getenv("MULTIPLEX_MODELS_PER_REPLICA", "1"))
+
+# Prompts replayed at replica startup to warm up CUDA kernels and allocators, and system prompts
+# (the exact leading text of requests) prefilled into the prefix cache. The replica is only
+# reported ready to Serve once both are done.
+WARMUP_PROMPTS = json.loads(os.getenv("WARMUP_PROMPTS", '["Warmup"]'))
+WARMUP_SYSTEM_PROMPTS = json.loads(os.getenv("WARMUP_SYSTEM_PROMPTS", "[]"))
+WARMUP_MAX_TOKENS = int(os.getenv("WARMUP_MAX_TOKENS", "16"))
+
+# Batch endpoint (POST <route>/batch): how many items of one batch are in flight at once. Items
+# beyond the engine's capacity wait in the fair-share scheduler, keeping the engine batch full.
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "256"))
+
+# Identical in-flight deterministic requests share one engine request.
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "true").lower() == "true"
+
+# Opt-in exact-match response cache for deterministic requests: "off", "local" (one cache per
+# replica) or "shared" (one named Ray actor used by every replica of the deployment).
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "off")
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+RESPONSE_CACHE_TTL_S = float(os.getenv("RESPONSE_CACHE_TTL_S", "3600"))
+
+
+# Response encodings a client can ask for in its Accept header; the default is NDJSON (None).
+SSE = "text/event-stream"
+MSGPACK = "application/x-msgpack"
+
+
+def response_encoding(headers) -> Optional[str]:
+    accept = headers.get("accept", "")
+    if MSGPACK in accept:
+        return MSGPACK
+    if SSE in accept:
+        return SSE
+    return None
+
+
+def encode_chunk(payload: dict, encoding: Optional[str]) -> bytes:
+    """
+    Frame a streamed payload as a newline-delimited JSON line, a Server-Sent Event or a msgpack
+    map prefixed with its length as a 4-byte big-endian integer.
+    """
+    if encoding == MSGPACK:
+        data = msgpack.packb(payload)
+        return len(data).to_bytes(4, "big") + data
+    data = json.dumps(payload)
+    if encoding == SSE:
+        return f"data: {data}\n\n".encode("utf-8")
+    return (data + "\n").encode("utf-8")
+
+
+def encode_response(content: dict, encoding: Optional[str]) -> Response:
+    """A non-streaming response body as JSON, or as a single msgpack map."""
+    if encoding == MSGPACK:
+        return Response(content=msgpack.packb(content), media_type=MSGPACK)
+    return Response(content=json.dumps(content))
+
+
+def parse_batch(body: bytes) -> list:
+    """
+    Read batch items from a JSON array, a {"requests": [...]} object or JSONL lines. Each item is
+    a request body like the single-prompt route takes, or just a prompt string.
+    Raises ValueError on malformed input.
+    """
+    try:
+        payload = json.loads(body)
+    except json.JSONDecodeError:
+        payload = [json.loads(line) for line in body.splitlines() if line.strip()]
+    if isinstance(payload, dict):
+        # A single request body or prompt, e.g. a JSONL upload with one line, is a batch of one.
+        payload = [payload] if "prompt" in payload else payload.get("requests")
+    elif isinstance(payload, str):
+        payload = [payload]
+    if not isinstance(payload, list):
+        raise ValueError("Expected a list of batch items")
+    items = [{"prompt": item} if isinstance(item, str) else item for item in payload]
+    if not all(isinstance(item, dict) and "prompt" in item for item in items):
+        raise ValueError("Every batch item needs a prompt")
+    return items
+
+
+def is_batch_request(request: Request) -> bool:
+    return request.url.path.rstrip("/").endswith("/batch")
+
+
+def adapter_affinity_key(adapter: str) -> str:
+    """Multiplexed model ID that routes requests for a LoRA adapter to replicas holding it."""
+    return f"lora:{adapter}"
+
+
+def prefix_bucket(prompt_token_ids: List[int]) -> str:
+    """
+    Map a prompt to the prefix bucket it is routed by: a hash of its leading PREFIX_AFFINITY_TOKENS
+    tokens, or of its whole blocks if it is shorter.
+    """
+    window = min(PREFIX_AFFINITY_TOKENS, len(prompt_token_ids))
+    prefix = prompt_token_ids[: window - window % PREFIX_CACHE_BLOCK_SIZE]
+    digest = hashlib.blake2b(",".join(map(str, prefix)).encode("utf-8"), digest_size=8).digest()
+    return f"prefix-{int.from_bytes(digest, 'big') % PREFIX_AFFINITY_BUCKETS}"
+
+
+class ResponseCache:
+    """
+    LRU cache of completions with a per-entry TTL and a bound on the total size in bytes. A
+    completion is a dict of the generated text, its token IDs, finish reason and token usage.
+    """
+
+    def __init__(self, max_bytes: int, ttl_s: float):
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self._entries = OrderedDict()  # key -> (expires_at, completion, size)
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, completion: dict) -> None:
+        size = len(key) + len(completion["text"].encode("utf-8")) + 8 * len(completion["token_ids"])
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl_s, completion, size)
+        self._size += size
+        while self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, key: str) -> None:
+        self._size -= self._entries.pop(key)[2]
+
+
+# The same cache hosted in a Ray actor, so replicas share hits with each other.
+SharedResponseCache = ray.remote(num_cpus=0)(ResponseCache)
+
+
+class AdmissionController:
+    """
+    Tracks the prompt + max_tokens budget reserved by the engine requests running on this
+    replica and how long the oldest of them has been waiting for its first token. New requests
+    are rejected while either exceeds its limit, so the load balancer and the autoscaler see
+    overload before every client's latency collapses.
+    """
+
+    def __init__(self, max_tokens: int, max_queue_s: float):
+        self.max_tokens = max_tokens
+        self.max_queue_s = max_queue_s
+        self.outstanding_tokens = 0
+        self.recent_queue_time = 0.0  # moving average of the wait for the first token
+        self._budgets = {}  # request_id -> reserved tokens
+        self._waiting = {}  # request_id -> admission time, oldest first
+        self._changed = asyncio.Event()  # set when a request starts or releases its budget
+
+    def queue_delay(self) -> float:
+        if not self._waiting:
+            return 0.0
+        return time.monotonic() - next(iter(self._waiting.values()))
+
+    def estimated_queue_time(self) -> float:
+        """How long a request admitted now is expected to wait for its first token."""
+        if not self._waiting:
+            return 0.0
+        return max(self.queue_delay(), self.recent_queue_time)
+
+    def try_admit(self, request_id: str, tokens: int) -> Optional[int]:
+        """Reserve budget for a request. Returns None if admitted, else a Retry-After in seconds."""
+        queue_delay = self.queue_delay()
+        over_queue = self.max_queue_s and queue_delay > self.max_queue_s
+        # A single request larger than the whole budget is still admitted on an idle replica.
+        over_tokens = self.max_tokens and self._budgets and self.outstanding_tokens + tokens > self.max_tokens
+        if over_queue or over_tokens:
+            return max(1, math.ceil(queue_delay))
+        self._budgets[request_id] = tokens
+        self._waiting[request_id] = time.monotonic()
+        self.outstanding_tokens += tokens
+        return None
+
+    async def admit(self, request_id: str, tokens: int) -> None:
+        """Reserve budget for a request, waiting until there is room instead of rejecting it."""
+        while self.try_admit(request_id, tokens) is not None:
+            self._changed.clear()
+            try:
+                # The queue delay also grows while nothing changes, so check again now and then.
+                await asyncio.wait_for(self._changed.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+
+    def started(self, request_id: str) -> None:
+        admitted = self._waiting.pop(request_id, None)
+        if admitted is not None:
+            self.recent_queue_time = 0.8 * self.recent_queue_time + 0.2 * (time.monotonic() - admitted)
+            self._changed.set()
+
+    def release(self, request_id: str) -> None:
+        self._waiting.pop(request_id, None)
+        self.outstanding_tokens -= self._budgets.pop(request_id, 0)
+        self._changed.set()
+
+
+class TokenBucket:
+    """
+    Token bucket that may go into debt: a request is allowed while the bucket is not empty and
+    is charged in full, so large requests and usage only known afterwards are metered too.
+    A rate of 0 disables the bucket.
+    """
+
+    def __init__(self, rate: float, burst_s: float = 10.0):
+        self.rate = rate
+        self.capacity = rate * burst_s
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def retry_after(self) -> Optional[int]:
+        """Returns None if the bucket allows a request, else the seconds until it will."""
+        if not self.rate:
+            return None
+        self._refill()
+        if self.tokens > 0:
+            return None
+        return max(1, math.ceil(-self.tokens / self.rate))
+
+    def charge(self, tokens: int) -> None:
+        if self.rate:
+            self._refill()
+            self.tokens -= tokens
+
+
+class Tenant:
+    def __init__(self, name: str, weight: float = 1.0, priority: int = 0, prompt_tokens_per_s: float = 0,
+                 generated_tokens_per_s: float = 0, api_keys=()):
+        self.name = name
+        self.weight = weight
+        self.priority = priority
+        self.prompt_bucket = TokenBucket(prompt_tokens_per_s)
+        self.generated_bucket = TokenBucket(generated_tokens_per_s)
+
+    def retry_after(self) -> Optional[int]:
+        retry_prompt = self.prompt_bucket.retry_after()
+        retry_generated = self.generated_bucket.retry_after()
+        if retry_prompt is None and retry_generated is None:
+            return None
+        return max(retry_prompt or 0, retry_generated or 0)
+
+
+class FairScheduler:
+    """
+    Weighted fair queuing of engine requests across tenants. At most max_running requests are
+    submitted to the engine at once; queued requests are released in order of their virtual
+    finish time (cost / weight), so each tenant gets engine capacity in proportion to its weight
+    and a batch tenant cannot starve interactive ones.
+    """
+
+    def __init__(self, max_running: int):
+        self.max_running = max_running
+        self.running = 0
+        self.virtual_time = 0.0
+        self._last_finish = {}  # tenant name -> virtual finish time of its latest request
+        self._heap = []  # (finish, seq, start, future)
+        self._seq = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return len(self._heap)
+
+    async def acquire(self, tenant: Tenant, cost: int) -> None:
+        if self.max_running <= 0:
+            return
+        start = max(self.virtual_time, self._last_finish.get(tenant.name, 0.0))
+        finish = start + cost / tenant.weight
+        self._last_finish[tenant.name] = finish
+        if self.running < self.max_running and not self._heap:
+            self.running += 1
+            self.virtual_time = start
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (finish, next(self._seq), start, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been granted just before the waiter was cancelled.
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        if self.max_running <= 0:
+            return
+        self.running -= 1
+        while self._heap and self.running < self.max_running:
+            _, _, start, future = heapq.heappop(self._heap)
+            if future.done():
+                continue
+            self.running += 1
+            self.virtual_time = start
+            future.set_result(None)
+
+
+class ServingMetrics:
+    """
+    Per-request serving metrics, exported through Ray's metrics agent to Prometheus with
+    model and route labels. Everything is recorded once per engine request when it ends.
+    """
+
+    LATENCY_BOUNDARIES = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+    TOKEN_LATENCY_BOUNDARIES = [0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1]
+
+    def __init__(self, model_id: str, route: str, num_speculative_tokens: int = 0):
+        self.num_speculative_tokens = num_speculative_tokens
+        tags = {"model": model_id, "route": route}
+        tag_keys = tuple(tags)
+
+        def histogram(name, description, boundaries):
+            metric = metrics.Histogram(name, description=description, boundaries=boundaries, tag_keys=tag_keys)
+            metric.set_default_tags(tags)
+            return metric
+
+        def counter(name, description):
+            metric = metrics.Counter(name, description=description, tag_keys=tag_keys)
+            metric.set_default_tags(tags)
+            return metric
+
+        self.queue_time = histogram(
+            "vllm_serve_queue_time_seconds",
+            "Time a request waited for a scheduler slot and in the engine queue.",
+            self.LATENCY_BOUNDARIES,
+        )
+        self.ttft = histogram(
+            "vllm_serve_time_to_first_token_seconds",
+            "Time from admission to the first generated token.",
+            self.LATENCY_BOUNDARIES,
+        )
+        self.tpot = histogram(
+            "vllm_serve_time_per_output_token_seconds",
+            "Average time between generated tokens after the first one.",
+            self.TOKEN_LATENCY_BOUNDARIES,
+        )
+        self.e2e_latency = histogram(
+            "vllm_serve_request_latency_seconds",
+            "Time from admission until the engine request ended.",
+            self.LATENCY_BOUNDARIES,
+        )
+        self.decode_throughput = histogram(
+            "vllm_serve_decode_tokens_per_second",
+            "Tokens per second a request generated after its first token.",
+            [5, 10, 20, 30, 40, 50, 60, 80, 100, 150, 200, 300],
+        )
+        self.spec_acceptance_rate = histogram(
+            "vllm_serve_spec_decode_acceptance_rate",
+            "Fraction of speculated tokens a request accepted, from its tokens per decode step.",
+            [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1],
+        )
+        self.prompt_tokens = counter("vllm_serve_prompt_tokens_total", "Prompt tokens submitted to the engine.")
+        self.cached_prompt_tokens = counter(
+            "vllm_serve_cached_prompt_tokens_total", "Prompt tokens served from the engine's prefix cache."
+        )
+        self.generated_tokens = counter("vllm_serve_generated_tokens_total", "Tokens generated by the engine.")
+        self.abandoned_requests = counter(
+            "vllm_serve_abandoned_requests_total", "Engine requests aborted before they finished."
+        )
+        self.abandoned_tokens = counter(
+            "vllm_serve_abandoned_tokens_total", "Tokens generated for engine requests that were aborted."
+        )
+        self.response_cache_hits = counter(
+            "vllm_serve_response_cache_hits_total", "Requests answered from the response cache."
+        )
+        self.prefix_affinity_requests = counter(
+            "vllm_serve_prefix_affinity_requests_total", "Requests routed to the replica by prefix bucket."
+        )
+        self.prefix_affinity_misses = counter(
+            "vllm_serve_prefix_affinity_misses_total",
+            "Prefix-routed requests whose bucket was new to the replica (1 - misses/requests is the hit rate).",
+        )
+        self.lora_adapter_hits = counter(
+            "vllm_serve_lora_adapter_hits_total", "Adapter requests whose adapter was already cached on the replica."
+        )
+        self.lora_adapter_loads = counter(
+            "vllm_serve_lora_adapter_loads_total", "Adapter requests that had to load their adapter from disk."
+        )
+        self.lora_adapter_evictions = counter(
+            "vllm_serve_lora_adapter_evictions_total", "Adapters evicted from the replica's LRU adapter cache."
+        )
+
+        def gauge(name, description):
+            metric = metrics.Gauge(name, description=description, tag_keys=tag_keys)
+            metric.set_default_tags(tags)
+            return metric
+
+        self.kv_cache_utilization = gauge(
+            "vllm_serve_kv_cache_utilization", "Fraction of the replica's GPU KV-cache blocks in use."
+        )
+        self.waiting_requests = gauge("vllm_serve_waiting_requests", "Sequences waiting in the engine queue.")
+        self.running_requests = gauge("vllm_serve_running_requests", "Sequences running in the engine.")
+        self.queued_requests = gauge(
+            "vllm_serve_queued_requests", "Requests waiting in the fair-share scheduler for an engine slot."
+        )
+        self.tokens_in_flight = gauge(
+            "vllm_serve_tokens_in_flight", "Prompt + max_tokens budget of the engine requests on the replica."
+        )
+
+        self.startup_time = metrics.Gauge(
+            "vllm_serve_startup_seconds",
+            description="Time the replica spent in each startup phase (download, verify, engine_init, warmup).",
+            tag_keys=tag_keys + ("phase",),
+        )
+        self.startup_time.set_default_tags(tags)
+
+    def record_startup(self, timings: Dict[str, float]) -> None:
+        for phase, seconds in timings.items():
+            self.startup_time.set(seconds, tags={"phase": phase})
+
+    def record_load(self, load: dict) -> None:
+        self.kv_cache_utilization.set(load["kv_cache_utilization"])
+        self.waiting_requests.set(load["waiting_requests"])
+        self.running_requests.set(load["running_requests"])
+        self.queued_requests.set(load["queued_requests"])
+        self.tokens_in_flight.set(load["tokens_in_flight"])
+
+    def record_request(self, start: float, scheduled: float, first_token: Optional[float], end: float,
+                       request_output, generated_tokens: int, engine_steps: int) -> None:
+        engine_metrics = getattr(request_output, "metrics", None)
+        engine_queue_time = getattr(engine_metrics, "time_in_queue", None) or 0.0
+        self.queue_time.observe(scheduled - start + engine_queue_time)
+        self.e2e_latency.observe(end - start)
+        if first_token is not None:
+            self.ttft.observe(first_token - start)
+            if generated_tokens > 1:
+                self.tpot.observe((end - first_token) / (generated_tokens - 1))
+                if end > first_token:
+                    self.decode_throughput.observe((generated_tokens - 1) / (end - first_token))
+            if self.num_speculative_tokens and engine_steps > 1:
+                # The first step is the prefill. Every decode step emits the accepted draft tokens
+                # plus one token from the target model.
+                tokens_per_step = (generated_tokens - 1) / (engine_steps - 1)
+                self.spec_acceptance_rate.observe(min(1.0, (tokens_per_step - 1) / self.num_speculative_tokens))
+        # Ray counters reject inc(0), e.g. for a request aborted right after its first step.
+        if request_output.prompt_token_ids:
+            self.prompt_tokens.inc(len(request_output.prompt_token_ids))
+        if generated_tokens:
+            self.generated_tokens.inc(generated_tokens)
+        # Only recent vLLM versions report how much of the prompt hit the prefix cache.
+        cached_tokens = getattr(request_output, "num_cached_tokens", None)
+        if cached_tokens:
+            self.cached_prompt_tokens.inc(cached_tokens)
+
+
+class LoRARegistry:
+    """
+    Resolves adapter names to the engine's LoRARequests. Adapters are looked up lazily the first
+    time they are requested and keep a stable integer ID for the replica's lifetime. vLLM holds
+    up to max_loras adapters on the GPU and keeps max_cpu_loras in an LRU cache in CPU memory,
+    reloading evicted ones from disk. The registry mirrors that LRU to count hits, loads and
+    evictions.
+    """
+
+    def __init__(self, adapter_dir: str, adapters: Dict[str, str], capacity: int, metrics: "ServingMetrics"):
+        self.adapter_dir = adapter_dir
+        self.adapters = adapters
+        self.capacity = capacity
+        self.metrics = metrics
+        self.ids = {}
+        self.resident = OrderedDict()
+
+    def path(self, name: str) -> Optional[str]:
+        if name in self.adapters:
+            return self.adapters[name]
+        # Names map to subdirectories, never to paths outside the adapter directory.
+        if not self.adapter_dir or name in ("", ".", "..") or os.path.basename(name) != name:
+            return None
+        path = os.path.join(self.adapter_dir, name)
+        return path if os.path.isfile(os.path.join(path, "adapter_config.json")) else None
+
+    def resolve(self, name: str) -> Optional[LoRARequest]:
+        """The LoRARequest for an adapter, or None if there is no such adapter."""
+        path = self.path(name)
+        if path is None:
+            return None
+        lora_id = self.ids.setdefault(name, len(self.ids) + 1)
+        if name in self.resident:
+            self.resident.move_to_end(name)
+            self.metrics.lora_adapter_hits.inc()
+        else:
+            self.resident[name] = lora_id
+            self.metrics.lora_adapter_loads.inc()
+            if len(self.resident) > self.capacity:
+                self.resident.popitem(last=False)
+                self.metrics.lora_adapter_evictions.inc()
+        return LoRARequest(name, lora_id, path)
+
+
+def kv_cache_autoscaling_policy(ctx):
+    """
+    Ray Serve custom autoscaling policy driven by the stats each replica reports from
+    record_autoscaling_stats. It scales up as soon as the mean KV-cache utilization exceeds
+    KV_CACHE_TARGET_UTILIZATION, or when sequences are waiting on a replica whose KV cache is
+    already at the target, so capacity arrives before vLLM starts preempting and recomputing
+    sequences. Replicas limited by sequence count rather than KV cache queue requests in their
+    fair-share scheduler instead; that backlog asks for enough replicas to run it alongside the
+    running requests. Scaling down waits for the deployment's downscale_delay_s.
+
+    This needs a Ray version with custom autoscaling policies and replica autoscaling stats
+    (newer than the 2.24 image used by this blueprint); configure it with
+    autoscaling_config.policy.policy_function: "vllm_serve:kv_cache_autoscaling_policy".
+    On older versions the same signals are still exported as vllm_serve_* gauges.
+    """
+    current = ctx.current_num_replicas
+    policy_state = dict(ctx.policy_state or {})
+
+    def replica_values(name):
+        return [float(value) for value in (ctx.aggregated_metrics.get(name) or {}).values()]
+
+    kv_cache_utilization = replica_values("kv_cache_utilization")
+    waiting_requests = replica_values("waiting_requests")
+    running_requests = sum(replica_values("running_requests"))
+    queued_requests = sum(replica_values("queued_requests"))
+    if not kv_cache_utilization:
+        return ctx.target_num_replicas, policy_state
+
+    mean_utilization = sum(kv_cache_utilization) / len(kv_cache_utilization)
+    desired = math.ceil(current * mean_utilization / KV_CACHE_TARGET_UTILIZATION)
+    saturated = any(
+        waiting > 0 and utilization >= KV_CACHE_TARGET_UTILIZATION
+        for waiting, utilization in zip(waiting_requests, kv_cache_utilization)
+    )
+    if saturated:
+        desired = max(desired, current + 1)
+    if queued_requests:
+        desired = max(desired, math.ceil(current * (running_requests + queued_requests) / max(running_requests, 1)))
+    desired = min(max(desired, ctx.capacity_adjusted_min_replicas), ctx.capacity_adjusted_max_replicas)
+
+    if desired < current:
+        now = time.time()
+        below_since = policy_state.setdefault("below_target_since", now)
+        if now - below_since < ctx.config.downscale_delay_s:
+            desired = current
+    else:
+        policy_state.pop("below_target_since", None)
+    return desired, policy_state
+
+
+class SharedGeneration:
+    """
+    A single engine request whose outputs are fanned out to every subscriber. Subscribers are
+    reference counted and the engine request is aborted only when the last one goes away.
+    Late subscribers start from the latest output, so requests that can be shared must use
+    cumulative (not delta) outputs.
+    """
+
+    def __init__(self, engine: AsyncLLMEngine, results_generator, request_id: str, on_done: Callable[[], None]):
+        # results_generator may still be waiting for a scheduler slot when the first
+        # subscribers join, so queued requests can be coalesced as well.
+        self.engine = engine
+        self.request_id = request_id
+        self.latest = None
+        self.error = None
+        self.done = False
+        self._on_done = on_done
+        self._queues = set()
+        self._task = asyncio.create_task(self._pump(results_generator))
+
+    async def _pump(self, results_generator) -> None:
+        try:
+            async for request_output in results_generator:
+                self.latest = request_output
+                for queue in self._queues:
+                    queue.put_nowait(request_output)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            for queue in self._queues:
+                queue.put_nowait(None)
+            self._on_done()
+
+    def subscribe(self) -> "Subscription":
+        queue = asyncio.Queue()
+        if self.latest is not None:
+            queue.put_nowait(self.latest)
+        if self.done:
+            queue.put_nowait(None)
+        self._queues.add(queue)
+        return Subscription(self, queue)
+
+    async def unsubscribe(self, queue: asyncio.Queue) -> bool:
+        if queue not in self._queues:
+            return False
+        self._queues.discard(queue)
+        if not self._queues and not self.done:
+            # Stop new requests from joining before the engine request goes away, and fail any
+            # that still subscribe rather than handing them a truncated output as a complete one.
+            self._on_done()
+            self.error = RuntimeError(f"Request {self.request_id} was aborted")
+            self._task.cancel()
+            await self.engine.abort(self.request_id)
+        return True
+
+
+class Subscription:
+    """
+    One client's view of a SharedGeneration. It must be closed with aclose() once the client
+    is done with it, even if it was never iterated, to release its reference.
+
+    watch() starts the request's cancellation watcher: a task that closes the subscription the
+    moment the client disconnects or the request's deadline passes, which ends the client's
+    iteration and aborts the engine request if no other client is waiting on it.
+    """
+
+    def __init__(self, generation: SharedGeneration, queue: asyncio.Queue):
+        self.generation = generation
+        self.cancel_reason = None
+        self._queue = queue
+        self._watcher = None
+
+    def watch(self, receive=None, timeout: Optional[float] = None) -> None:
+        if receive is not None or timeout is not None:
+            self._watcher = asyncio.create_task(self._watch(receive, timeout))
+
+    async def _watch(self, receive, timeout: Optional[float]) -> None:
+        try:
+            await asyncio.wait_for(self._wait_for_disconnect(receive), timeout)
+            self.cancel_reason = "disconnect"
+        except asyncio.TimeoutError:
+            self.cancel_reason = "deadline"
+        logger.warning(f"Cancelling a subscriber of request {self.generation.request_id}: {self.cancel_reason}")
+        await self.aclose()
+
+    @staticmethod
+    async def _wait_for_disconnect(receive) -> None:
+        if receive is None:
+            await asyncio.Event().wait()
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        request_output = await self._queue.get()
+        if request_output is None:
+            await self.aclose()
+            # A subscription that was cancelled itself ends quietly, even if that aborted the generation.
+            if self.generation.error is not None and self.cancel_reason is None:
+                raise self.generation.error
+            raise StopAsyncIteration
+        return request_output
+
+    async def aclose(self) -> None:
+        if self._watcher is not None and self._watcher is not asyncio.current_task():
+            self._watcher.cancel()
+        if await self.generation.unsubscribe(self._queue):
+            # Wake up a consumer still waiting for the next output.
+            self._queue.put_nowait(None)
+
+
+def load_tokenizer(model_id: str):
+    """
+    The model's tokenizer, read from the staged weights when WEIGHTS_DIR holds them on this node,
+    else from the Hugging Face Hub.
+    """
+    from transformers import AutoTokenizer
+
+    if WEIGHTS_DIR:
+        path = staged_path(model_id, WEIGHTS_DIR, MODEL_REVISION)
+        if verify(path, checksum=False):
+            return AutoTokenizer.from_pretrained(path)
+    # Pass the token rather than calling login(), which prompts for one when it is unset.
+    return AutoTokenizer.from_pretrained(model_id, revision=MODEL_REVISION, token=os.getenv("HUGGING_FACE_HUB_TOKEN"))
+
+
+def engine_kwargs(max_model_len: Optional[int] = None, max_num_seqs: Optional[int] = None,
+                  max_num_batched_tokens: Optional[int] = None, model: Optional[str] = None) -> dict:
+    """
+    vLLM engine arguments shared by VLLMDeployment and the offline pipeline (vllm_offline.py),
+    so both run the model with the same configuration. Limits not passed in come from the environment.
+    """
+    kwargs = {
+        "model": model or os.getenv("MODEL_ID", "mistralai/Mistral-7B-Instruct-v0.2"),  # Model identifier from Hugging Face Hub or local path.
+        "dtype": "auto",  # Automatically determine the data type (e.g., float16 or float32) for model weights and computations.
+        "gpu_memory_utilization": float(os.getenv("GPU_MEMORY_UTILIZATION", "0.8")),  # Percentage of GPU memory to utilize, reserving some for overhead.
+        "max_model_len": max_model_len or int(os.getenv("MAX_MODEL_LEN", "4096")),  # Maximum sequence length (in tokens) the model can handle, including both input and output tokens.
+        "max_num_seqs": max_num_seqs or int(os.getenv("MAX_NUM_SEQ", "512")),  # Maximum number of sequences (requests) to process in parallel.
+        "max_num_batched_tokens": max_num_batched_tokens or int(os.getenv("MAX_NUM_BATCHED_TOKENS", "32768")),  # Maximum number of tokens processed in a single batch across all sequences (max_model_len * max_num_seqs).
+        "trust_remote_code": True,  # Allow execution of untrusted code from the model repository (use with caution).
+        "enable_chunked_prefill": False,  # Disable chunked prefill to avoid compatibility issues with prefix caching.
+        "tokenizer_pool_size": 4,  # Number of tokenizer instances to handle concurrent requests efficiently.
+        "tokenizer_pool_type": "ray",  # Pool type for tokenizers; 'ray' uses Ray for distributed processing.
+        "max_parallel_loading_workers": 2,  # Number of parallel workers to load the model concurrently.
+        "pipeline_parallel_size": 1,  # Number of pipeline parallelism stages; typically set to 1 unless using model parallelism.
+        "tensor_parallel_size": 1,  # Number of tensor parallelism stages; typically set to 1 unless using model parallelism.
+        "enable_prefix_caching": True,  # Enable prefix caching to improve performance for similar prompt prefixes.
+        "enforce_eager": True,
+    }
+    if LORA_ADAPTER_DIR or LORA_ADAPTERS:
+        kwargs.update(enable_lora=True, max_loras=MAX_LORAS, max_lora_rank=MAX_LORA_RANK, max_cpu_loras=MAX_CPU_LORAS)
+    if SPECULATIVE_MODEL:
+        # Speculative decoding runs on the v2 block manager.
+        kwargs.update(speculative_model=SPECULATIVE_MODEL, num_speculative_tokens=NUM_SPECULATIVE_TOKENS,
+                      use_v2_block_manager=True)
+        if SPECULATIVE_MODEL == "[ngram]":
+            kwargs.update(ngram_prompt_lookup_max=NGRAM_PROMPT_LOOKUP_MAX, ngram_prompt_lookup_min=NGRAM_PROMPT_LOOKUP_MIN)
+    return kwargs
+
+
+@serve.deployment(name="mistral-deployment", route_prefix=ROUTE_PREFIX,
     ray_actor_options={"num_gpus": 1},
     autoscaling_config={"min_replicas": 1, "max_replicas": 2},
 )
 class VLLMDeployment:
-    def __init__(self, **kwargs):
+    async def __init__(self, max_model_len: Optional[int] = None, max_num_seqs: Optional[int] = None,
+                 max_num_batched_tokens: Optional[int] = None):
+        # Context-length pools pass their own engine limits; otherwise they come from the environment.
+        self.model_id = os.getenv("MODEL_ID", "mistralai/Mistral-7B-Instruct-v0.2")
         hf_token = os.getenv("HUGGING_FACE_HUB_TOKEN")
-        logger.info(f"token: {hf_token=}")
-        if not hf_token:
-            raise ValueError("HUGGING_FACE_HUB_TOKEN environment variable is not set")
-        login(token=hf_token)
-        logger.info("Successfully logged in to Hugging Face Hub")
+        # Seconds spent in each startup phase, reported once the replica is up.
+        self.startup_timings = {}
+        if WEIGHTS_DIR:
+            # Staged weights are loaded from local disk; the token is only used if they need downloading.
+            model, timings = stage_weights(self.model_id, WEIGHTS_DIR, MODEL_REVISION, hf_token)
+            self.startup_timings.update(timings)
+        else:
+            logger.info(f"token: {hf_token=}")
+            if not hf_token:
+                raise ValueError("HUGGING_FACE_HUB_TOKEN environment variable is not set")
+            login(token=hf_token)
+            logger.info("Successfully logged in to Hugging Face Hub")
+            model = self.model_id
 
         args = AsyncEngineArgs(
-            model=os.getenv("MODEL_ID", "mistralai/Mistral-7B-Instruct-v0.2"),  # Model identifier from Hugging Face Hub or local path.
-            dtype="auto",  # Automatically determine the data type (e.g., float16 or float32) for model weights and computations.
-            gpu_memory_utilization=float(os.getenv("GPU_MEMORY_UTILIZATION", "0.8")),  # Percentage of GPU memory to utilize, reserving some for overhead.
-            max_model_len=int(os.getenv("MAX_MODEL_LEN", "4096")),  # Maximum sequence length (in tokens) the model can handle, including both input and output tokens.
-            max_num_seqs=int(os.getenv("MAX_NUM_SEQ", "512")),  # Maximum number of sequences (requests) to process in parallel.
-            max_num_batched_tokens=int(os.getenv("MAX_NUM_BATCHED_TOKENS", "32768")),  # Maximum number of tokens processed in a single batch across all sequences (max_model_len * max_num_seqs).
-            trust_remote_code=True,  # Allow execution of untrusted code from the model repository (use with caution).
-            enable_chunked_prefill=False,  # Disable chunked prefill to avoid compatibility issues with prefix caching.
-            tokenizer_pool_size=4,  # Number of tokenizer instances to handle concurrent requests efficiently.
-            tokenizer_pool_type="ray",  # Pool type for tokenizers; 'ray' uses Ray for distributed processing.
-            max_parallel_loading_workers=2,  # Number of parallel workers to load the model concurrently.
-            pipeline_parallel_size=1,  # Number of pipeline parallelism stages; typically set to 1 unless using model parallelism.
-            tensor_parallel_size=1,  # Number of tensor parallelism stages; typically set to 1 unless using model parallelism.
-            enable_prefix_caching=True,  # Enable prefix caching to improve performance for similar prompt prefixes.
-            enforce_eager=True,
+            **engine_kwargs(max_model_len, max_num_seqs, max_num_batched_tokens, model=model),
             disable_log_requests=True,
         )
+        if WEIGHTS_DIR:
+            # Memory-map the staged safetensors rather than falling back to any other format.
+            args.load_format = "safetensors"
+        if ENGINE_SUPPORTS_PRIORITY:
+            # Let the engine order waiting requests by the priority of their tenant.
+            args.scheduling_policy = "priority"
 
+        start = time.monotonic()
+        # vLLM loads the weights while it builds the engine, so this covers loading and engine init.
         self.engine = AsyncLLMEngine.from_engine_args(args)
+        self.startup_timings["engine_init"] = time.monotonic() - start
         self.max_model_len = args.max_model_len
+        # The engine's tokenizer group is backed by the Ray tokenizer pool configured above, so
+        # encoding through it keeps long prompts from blocking the replica's event loop.
+        self.tokenizer_group = self.engine.engine.get_tokenizer_group()
         logger.info(f"VLLM Engine initialized with max_model_len: {self.max_model_len}")
 
-    async def stream_results(self, results_generator) -> AsyncGenerator[bytes, None]:
-        num_returned = 0
-        async for request_output in results_generator:
-            text_outputs = [output.text for output in request_output.outputs]
-            assert len(text_outputs) == 1
-            text_output = text_outputs[0][num_returned:]
-            ret = {"text": text_output}
-            yield (json.dumps(ret) + "\n").encode("utf-8")
-            num_returned += len(text_output)
+        # Engine requests shared by identical in-flight requests, keyed like the response cache.
+        self.inflight = {}
+        self.admission = AdmissionController(ADMISSION_MAX_TOKENS, ADMISSION_MAX_QUEUE_S)
+        self.metrics = ServingMetrics(
+            self.model_id, ROUTE_PREFIX, args.num_speculative_tokens if args.speculative_model else 0
+        )
+        self.load = {
+            "kv_cache_utilization": 0.0, "waiting_requests": 0, "running_requests": 0, "queued_requests": 0,
+            "tokens_in_flight": 0,
+        }
+        self.loras = LoRARegistry(LORA_ADAPTER_DIR, LORA_ADAPTERS, MAX_CPU_LORAS, self.metrics) if args.enable_lora else None
+        self.scheduler = FairScheduler(int(SCHEDULER_MAX_RUNNING) if SCHEDULER_MAX_RUNNING else args.max_num_seqs)
+        self.load_reporter = asyncio.create_task(self.report_load())
+        self.tenants = {name: Tenant(name, **settings) for name, settings in TENANTS.items()}
+        self.tenants.setdefault("default", Tenant("default"))
+        self.api_keys = {
+            api_key: self.tenants[name] for name, settings in TENANTS.items() for api_key in settings.get("api_keys", ())
+        }
+
+        self.response_cache = None
+        if RESPONSE_CACHE == "local":
+            self.response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL_S)
+        elif RESPONSE_CACHE == "shared":
+            # Versioned name: a detached actor from a release that cached plain text is not reused.
+            self.response_cache = SharedResponseCache.options(
+                name="vllm-response-cache-v2", get_if_exists=True, lifetime="detached"
+            ).remote(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL_S)
+        elif RESPONSE_CACHE != "off":
+            raise ValueError(f"Unsupported RESPONSE_CACHE mode: {RESPONSE_CACHE}")
+
+        # Serve awaits the constructor, so the replica takes traffic only after warmup.
+        start = time.monotonic()
+        await self.warmup()
+        self.startup_timings["warmup"] = time.monotonic() - start
+        self.metrics.record_startup(self.startup_timings)
+        logger.info(f"Replica startup timings (s): {self.startup_timings}")
+
+    async def warmup(self) -> None:
+        """
+        Run WARMUP_PROMPTS through the engine and prefill every WARMUP_SYSTEM_PROMPTS entry, so
+        the first requests neither pay for CUDA and allocator warmup nor miss the prefix cache.
+        """
+        async def run(prompt: str, max_tokens: int) -> None:
+            sampling_params = SamplingParams(max_tokens=max_tokens, temperature=0)
+            async for _ in self.engine.generate(prompt, sampling_params, random_uuid()):
+                pass
+
+        await asyncio.gather(
+            *(run(prompt, WARMUP_MAX_TOKENS) for prompt in WARMUP_PROMPTS),
+            *(run(prompt, 1) for prompt in WARMUP_SYSTEM_PROMPTS),
+        )
+
+    def request_key(self, input_token_ids, sampling_kwargs, adapter: Optional[str] = None) -> Optional[str]:
+        """
+        Key deterministic requests on the model and adapter, the prompt token IDs and the sampling
+        parameters. Returns None when the request's output cannot be reused by another one.
+        """
+        if sampling_kwargs["temperature"] > DETERMINISTIC_MAX_TEMPERATURE:
+            return None
+        material = json.dumps([self.model_id, adapter, input_token_ids, sampling_kwargs], sort_keys=True)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    async def cache_get(self, key: str) -> Optional[dict]:
+        if RESPONSE_CACHE == "shared":
+            return await self.response_cache.get.remote(key)
+        return self.response_cache.get(key)
+
+    async def cache_put(self, key: str, text: str, token_ids, finish_reason: str, prompt_tokens: int) -> None:
+        completion = {
+            "text": text,
+            "token_ids": list(token_ids),
+            "finish_reason": finish_reason,
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(token_ids)},
+        }
+        if RESPONSE_CACHE == "shared":
+            await self.response_cache.put.remote(key, completion)
+        else:
+            self.response_cache.put(key, completion)
+
+    async def stream_cached(self, completion: dict, encoding: Optional[str]) -> AsyncGenerator[bytes, None]:
+        """Stream a cached completion in the same frames as stream_results."""
+        if encoding == MSGPACK:
+            yield encode_chunk({"text": completion["text"], "token_ids": completion["token_ids"]}, encoding)
+            final = {"text": "", "finish_reason": completion["finish_reason"], "usage": completion["usage"]}
+            yield encode_chunk(final, encoding)
+            return
+        yield encode_chunk({"text": completion["text"]}, encoding)
+        if encoding == SSE:
+            yield b"data: [DONE]\n\n"
+
+    async def stream_results(
+        self, results_generator: Subscription, delta: bool, encoding: Optional[str], cache_key: Optional[str] = None
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Stream the generated text as coalesced chunks. With delta outputs every engine step
+        carries only the new text; otherwise only the unseen tail of the cumulative text is
+        sliced off, so the work per step stays proportional to the new tokens.
+        msgpack chunks also carry the new token IDs, and a last frame reports the finish reason
+        and token usage.
+        When a cache key is given, the full text of a completed generation is cached.
+        The subscription is released when the stream ends, including on client disconnect.
+        """
+        chunks = []
+        chunk_token_ids = []
+        finish_reason = None
+        num_chars = 0
+        num_tokens = 0
+        prompt_tokens = 0
+        pending = []
+        pending_token_ids = []
+        last_flush = None
+        try:
+            async for request_output in results_generator:
+                output = request_output.outputs[0]
+                if delta:
+                    text = output.text
+                    token_ids = output.token_ids
+                    num_tokens += len(token_ids)
+                else:
+                    text = output.text[num_chars:]
+                    token_ids = output.token_ids[num_tokens:]
+                    num_chars += len(text)
+                    num_tokens += len(token_ids)
+                pending.append(text)
+                pending_token_ids.extend(token_ids)
+
+                # The first chunk is flushed right away to keep time-to-first-token unchanged.
+                now = time.monotonic()
+                if (
+                    request_output.finished
+                    or last_flush is None
+                    or len(pending_token_ids) >= STREAM_CHUNK_TOKENS
+                    or now - last_flush >= STREAM_CHUNK_INTERVAL_S
+                ):
+                    chunk = "".join(pending)
+                    if cache_key is not None:
+                        chunks.append(chunk)
+                        chunk_token_ids.extend(pending_token_ids)
+                    if encoding == MSGPACK:
+                        if pending_token_ids:
+                            yield encode_chunk({"text": chunk, "token_ids": pending_token_ids}, encoding)
+                    elif chunk:
+                        yield encode_chunk({"text": chunk}, encoding)
+                    pending = []
+                    pending_token_ids = []
+                    last_flush = now
+                finish_reason = output.finish_reason
+                prompt_tokens = len(request_output.prompt_token_ids)
+        finally:
+            await results_generator.aclose()
+
+        if results_generator.cancel_reason == "deadline":
+            # The deadline passed mid-generation: flush what was generated so far and say why
+            # the stream ends early.
+            chunk = "".join(pending)
+            finish_reason = "deadline"
+            if encoding == MSGPACK:
+                if pending_token_ids:
+                    yield encode_chunk({"text": chunk, "token_ids": pending_token_ids}, encoding)
+            else:
+                if chunk:
+                    yield encode_chunk({"text": chunk}, encoding)
+                yield encode_chunk({"text": "", "finish_reason": finish_reason}, encoding)
+        if cache_key is not None and finish_reason in ("stop", "length"):
+            await self.cache_put(cache_key, "".join(chunks), chunk_token_ids, finish_reason, prompt_tokens)
+        if encoding == MSGPACK:
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": num_tokens}
+            yield encode_chunk({"text": "", "finish_reason": finish_reason, "usage": usage}, encoding)
+        elif encoding == SSE:
+            yield b"data: [DONE]\n\n"
+
+    def sample_load(self) -> dict:
+        """Read KV-cache utilization and queue lengths from the engine's scheduler(s) and the fair-share scheduler."""
+        llm_engine = self.engine.engine
+        schedulers = llm_engine.scheduler if isinstance(llm_engine.scheduler, list) else [llm_engine.scheduler]
+        total_blocks = llm_engine.cache_config.num_gpu_blocks * len(schedulers)
+        free_blocks = sum(scheduler.block_manager.get_num_free_gpu_blocks() for scheduler in schedulers)
+        return {
+            "kv_cache_utilization": 1.0 - free_blocks / total_blocks if total_blocks else 0.0,
+            "waiting_requests": sum(len(scheduler.waiting) for scheduler in schedulers),
+            "running_requests": sum(len(scheduler.running) for scheduler in schedulers),
+            # Requests held back by the fair-share scheduler never reach the engine's queue.
+            "queued_requests": self.scheduler.queued,
+            "tokens_in_flight": self.admission.outstanding_tokens,
+        }
+
+    async def report_load(self) -> None:
+        while True:
+            try:
+                self.load = self.sample_load()
+                self.metrics.record_load(self.load)
+            except Exception as e:
+                logger.warning(f"Failed to sample engine load: {e}")
+            await asyncio.sleep(LOAD_REPORT_INTERVAL_S)
+
+    def record_autoscaling_stats(self) -> dict:
+        """Replica stats consumed by kv_cache_autoscaling_policy on Ray versions that support it."""
+        return self.load
+
+    def resolve_tenant(self, headers) -> Tenant:
+        """The configured tenant named by TENANT_HEADER or owning the API key, else the default tenant."""
+        tenant = self.tenants.get(headers.get(TENANT_HEADER))
+        if tenant is not None:
+            return tenant
+        api_key = headers.get("authorization", "").removeprefix("Bearer ").strip()
+        return self.api_keys.get(api_key, self.tenants["default"])
+
+    async def run_generation(self, inputs, sampling_params, request_id: str, tenant: Tenant, cost: int,
+                             lora_request: Optional[LoRARequest] = None):
+        """
+        Wait for a fair-share scheduler slot, then run the engine request and account for it
+        until it finishes, fails or is aborted.
+        """
+        delta = RequestOutputKind is not None and sampling_params.output_kind == RequestOutputKind.DELTA
+        start = scheduled = time.monotonic()
+        first_token = None
+        last_output = None
+        generated_tokens = 0
+        engine_steps = 0
+        try:
+            await self.scheduler.acquire(tenant, cost)
+            scheduled = time.monotonic()
+            try:
+                kwargs = {"priority": tenant.priority} if ENGINE_SUPPORTS_PRIORITY else {}
+                async for request_output in self.engine.generate(
+                    inputs, sampling_params, request_id, lora_request=lora_request, **kwargs
+                ):
+                    if first_token is None:
+                        first_token = time.monotonic()
+                        self.admission.started(request_id)
+                    num_tokens = len(request_output.outputs[0].token_ids)
+                    generated_tokens = generated_tokens + num_tokens if delta else num_tokens
+                    engine_steps += 1
+                    last_output = request_output
+                    yield request_output
+            finally:
+                self.scheduler.release()
+        finally:
+            self.admission.release(request_id)
+            tenant.generated_bucket.charge(generated_tokens)
+            if last_output is None or not last_output.finished:
+                self.metrics.abandoned_requests.inc()
+                # Ray counters reject inc(0), which would mask the request's own error.
+                if generated_tokens:
+                    self.metrics.abandoned_tokens.inc(generated_tokens)
+            if last_output is not None:
+                self.metrics.record_request(
+                    start, scheduled, first_token, time.monotonic(), last_output, generated_tokens, engine_steps
+                )
+
+    def start_generation(
+        self, inputs, sampling_params, request_id: str, key: Optional[str], tenant: Tenant, cost: int,
+        lora_request: Optional[LoRARequest] = None,
+    ) -> SharedGeneration:
+        """Submit a request to the engine, registering it for coalescing when it has a key."""
+
+        def on_done():
+            if key is not None and self.inflight.get(key) is generation:
+                del self.inflight[key]
+
+        results_generator = self.run_generation(inputs, sampling_params, request_id, tenant, cost, lora_request)
+        generation = SharedGeneration(self.engine, results_generator, request_id, on_done)
+        if key is not None:
+            self.inflight[key] = generation
+        return generation
+
+    @serve.multiplexed(max_num_models_per_replica=PREFIX_AFFINITY_BUCKETS_PER_REPLICA)
+    async def load_affinity_key(self, key: str) -> str:
+        """
+        Serve calls this only when a prefix bucket or adapter key is not resident on the replica
+        yet. Nothing is loaded here: the prefix cache fills on its own and adapters are loaded by
+        the engine. For prefix buckets this counts as an affinity miss.
+        """
+        if not key.startswith(adapter_affinity_key("")):
+            self.metrics.prefix_affinity_misses.inc()
+        return key
+
+    async def generate(self, request_dict: dict, headers: dict,
+                       prompt_token_ids: Optional[List[int]] = None) -> AsyncGenerator:
+        """
+        Entry point for VLLMRouter. Yields the response status, headers and media type
+        first, then the body. Client disconnects reach the replica as Ray request cancellation.
+        prompt_token_ids is the prompt as the router tokenized it, if it did.
+        """
+        affinity_key = serve.get_multiplexed_model_id()
+        if affinity_key:
+            if not affinity_key.startswith(adapter_affinity_key("")):
+                self.metrics.prefix_affinity_requests.inc()
+            await self.load_affinity_key(affinity_key)
 
-    async def may_abort_request(self, request_id) -> None:
-        await self.engine.abort(request_id)
+        response = await self.handle_request(request_dict, headers, prompt_token_ids=prompt_token_ids)
+        yield {
+            "status_code": response.status_code,
+            "media_type": response.media_type,
+            "headers": {k: v for k, v in response.headers.items() if k not in ("content-length", "content-type")},
+        }
+        if isinstance(response, StreamingResponse):
+            async for chunk in response.body_iterator:
+                yield chunk
+        else:
+            yield response.body
+
+    @staticmethod
+    def request_timeout(request_dict: dict, headers) -> Optional[float]:
+        """
+        The request's deadline in seconds from now: the client's, capped by REQUEST_TIMEOUT_S.
+        Raises ValueError unless the client's timeout is a positive, finite number of seconds.
+        """
+        timeouts = [float(t) for t in (request_dict.pop("timeout", None), headers.get(TIMEOUT_HEADER)) if t is not None]
+        if not all(math.isfinite(t) and t > 0 for t in timeouts):
+            raise ValueError("Request timeout must be a positive number of seconds")
+        if REQUEST_TIMEOUT_S:
+            timeouts.append(REQUEST_TIMEOUT_S)
+        return min(timeouts) if timeouts else None
+
+    async def generate_batch(self, items: list, headers, indices: Optional[List[int]] = None,
+                             prompt_token_ids: Optional[List[Optional[List[int]]]] = None) -> AsyncGenerator[bytes, None]:
+        """
+        Submit every batch item at once (up to BATCH_MAX_CONCURRENCY in flight) and stream the
+        results back as NDJSON lines in completion order, each tagged with the item's index and
+        status code, or with an error for items that fail. Closing the stream cancels the items
+        that are still running. Items wait for their tenant's rate limit and the admission budget
+        rather than being rejected, as BATCH_MAX_CONCURRENCY already bounds their load.
+        VLLMRouter passes the items' indices in the whole batch and their prompt token IDs.
+        """
+        semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+        # Results are re-encoded as NDJSON lines, so items are answered in JSON.
+        headers = {name: value for name, value in headers.items() if name != "accept"}
+
+        indices = indices or list(range(len(items)))
+        prompt_token_ids = prompt_token_ids or [None] * len(items)
+
+        async def run(index: int, item: dict, token_ids: Optional[List[int]]) -> dict:
+            # A failing item gets an error line of its own instead of ending the whole batch.
+            try:
+                async with semaphore:
+                    response = await self.handle_request(
+                        dict(item, stream=False), headers, prompt_token_ids=token_ids, wait=True
+                    )
+            except (TypeError, ValueError) as e:
+                return {"index": index, "status_code": 400, "error": f"Invalid request: {e}"}
+            except Exception as e:
+                logger.exception(f"Batch item {index} failed")
+                return {"index": index, "status_code": 500, "error": str(e)}
+            result = json.loads(response.body) if response.body else {}
+            result.update(index=index, status_code=response.status_code)
+            return result
+
+        tasks = [asyncio.create_task(run(*args)) for args in zip(indices, items, prompt_token_ids)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield (json.dumps(await task) + "\n").encode("utf-8")
+        finally:
+            for task in tasks:
+                task.cancel()
 
     async def __call__(self, request: Request) -> Response:
+        if is_batch_request(request):
+            try:
+                items = parse_batch(await request.body())
+            except ValueError as e:
+                return JSONResponse(status_code=400, content={"error": f"Invalid batch: {e}"})
+            return StreamingResponse(self.generate_batch(items, request.headers), media_type="application/x-ndjson")
+
         try:
             request_dict = await request.json()
         except json.JSONDecodeError:
             return JSONResponse(status_code=400, content={"error": "Invalid JSON in request body"})
+        return await self.handle_request(request_dict, request.headers, request.receive)
+
+    async def wait_for_capacity(self, request_id: str, tenant: Tenant, cost: int) -> None:
+        """Wait for the tenant's rate limit, then reserve the request's admission budget."""
+        while (retry_after := tenant.retry_after()) is not None:
+            await asyncio.sleep(retry_after)
+        await self.admission.admit(request_id, cost)
 
+    async def handle_request(self, request_dict: dict, headers, receive=None,
+                             prompt_token_ids: Optional[List[int]] = None, wait: bool = False) -> Response:
+        """
+        Serve one generation request. receive is the ASGI receive channel of a direct HTTP
+        request, watched for client disconnects; handle calls from the router are cancelled by
+        Ray instead. prompt_token_ids is the router's tokenization of the prompt; token IDs in
+        the request body are never used, since the engine does not range-check them and they
+        need not match the prompt the request is cached and coalesced under.
+        With wait, a request over its tenant's rate limit or the admission budget waits, until
+        its deadline at most, instead of being rejected with 429 or 503.
+        """
         context_length = request_dict.pop("context_length", 8192)  # Default to 8k
 
         # Ensure context length is either 8k or 32k
@@ -78,17 +1289,37 @@ class VLLMDeployment:
             context_length = 8192  # Default to 8k if invalid
         prompt = request_dict.pop("prompt")
         stream = request_dict.pop("stream", False)
+        try:
+            timeout = self.request_timeout(request_dict, headers)
+        except (TypeError, ValueError):
+            return JSONResponse(status_code=400, content={"error": "Invalid request timeout"})
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        # Clients asking for text/event-stream get Server-Sent-Events framing instead of NDJSON,
+        # internal callers asking for application/x-msgpack get length-prefixed msgpack frames.
+        encoding = response_encoding(headers)
+
+        request_id = random_uuid()
 
-        # Get model config and tokenizer
-        model_config = await self.engine.get_model_config()
-        tokenizer = await self.engine.get_tokenizer()
+        adapter = request_dict.pop("adapter", None)
+        lora_request = None
+        if adapter is not None:
+            lora_request = self.loras.resolve(adapter) if self.loras is not None else None
+            if lora_request is None:
+                return JSONResponse(status_code=404, content={"error": f"Unknown adapter: {adapter}"})
 
-        input_token_ids = tokenizer.encode(prompt)
+        # Tokenize once, off the event loop, unless the router already did. The token IDs are
+        # handed to the engine below so vLLM does not tokenize the prompt a second time.
+        request_dict.pop("prompt_token_ids", None)
+        input_token_ids = prompt_token_ids
+        if input_token_ids is None:
+            input_token_ids = await self.tokenizer_group.encode_async(
+                prompt=prompt, request_id=request_id, lora_request=lora_request
+            )
         input_tokens = len(input_token_ids)
-        max_possible_new_tokens = min(context_length, model_config.max_model_len) - input_tokens
+        max_possible_new_tokens = min(context_length, self.max_model_len) - input_tokens
         max_new_tokens = min(request_dict.get("max_tokens", 8192), max_possible_new_tokens)
 
-        sampling_params = SamplingParams(
+        sampling_kwargs = dict(
             max_tokens=max_new_tokens,
             temperature=request_dict.get("temperature", 0.7),
             top_p=request_dict.get("top_p", 0.9),
@@ -96,36 +1327,440 @@ class VLLMDeployment:
             stop=request_dict.get("stop", None),
         )
 
-        request_id = random_uuid()
-        logger.info(f"Processing request {request_id} with {input_tokens} input tokens")
+        # Exact-match cache hits skip the engine entirely.
+        key = self.request_key(input_token_ids, sampling_kwargs, adapter)
+        cache_key = key if self.response_cache is not None else None
+        if cache_key is not None:
+            cached = await self.cache_get(cache_key)
+            if cached is not None:
+                logger.info(f"Serving request {request_id} from the response cache")
+                self.metrics.response_cache_hits.inc()
+                if stream:
+                    return StreamingResponse(
+                        self.stream_cached(cached, encoding),
+                        media_type=encoding,
+                    )
+                ret = {"text": [prompt + cached["text"]]}
+                if encoding == MSGPACK:
+                    ret.update(token_ids=cached["token_ids"], usage=cached["usage"])
+                return encode_response(ret, encoding)
+
+        # Identical deterministic requests already in flight are joined instead of resubmitted.
+        coalesce_key = key if COALESCE_REQUESTS else None
+        generation = self.inflight.get(coalesce_key) if coalesce_key is not None else None
+        if generation is not None:
+            logger.info(f"Coalescing request {request_id} onto in-flight request {generation.request_id}")
+            delta = False
+        else:
+            # Streaming requests only need the new text of every step when the engine supports
+            # it, unless later identical requests may join and need the cumulative output.
+            delta = stream and coalesce_key is None and RequestOutputKind is not None
+            if delta:
+                sampling_kwargs["output_kind"] = RequestOutputKind.DELTA
+            sampling_params = SamplingParams(**sampling_kwargs)
+
+            tenant = self.resolve_tenant(headers)
+            cost = input_tokens + max_new_tokens
+            if wait:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                try:
+                    await asyncio.wait_for(self.wait_for_capacity(request_id, tenant, cost), remaining)
+                except asyncio.TimeoutError:
+                    return JSONResponse(status_code=504, content={"error": "Request timed out"})
+            else:
+                retry_after = tenant.retry_after()
+                if retry_after is not None:
+                    logger.warning(f"Rate limiting request {request_id} of tenant {tenant.name}")
+                    return JSONResponse(
+                        status_code=429,
+                        content={"error": f"Token rate limit exceeded for tenant {tenant.name}"},
+                        headers={"Retry-After": str(retry_after)},
+                    )
 
-        results_generator = self.engine.generate(prompt, sampling_params, request_id)
+                # Reject up front what cannot start before its deadline instead of running it in vain.
+                estimated_queue_time = self.admission.estimated_queue_time()
+                if timeout is not None and estimated_queue_time >= timeout:
+                    logger.warning(f"Rejecting request {request_id}: {estimated_queue_time:.1f}s queue exceeds its deadline")
+                    return JSONResponse(
+                        status_code=503,
+                        content={"error": "Request deadline cannot be met, retry later"},
+                        headers={"Retry-After": str(max(1, math.ceil(estimated_queue_time)))},
+                    )
+
+                retry_after = self.admission.try_admit(request_id, cost)
+                if retry_after is not None:
+                    logger.warning(f"Shedding request {request_id}: {self.admission.outstanding_tokens} tokens outstanding")
+                    return JSONResponse(
+                        status_code=503,
+                        content={"error": "Server is overloaded, retry later"},
+                        headers={"Retry-After": str(retry_after)},
+                    )
+
+            tenant.prompt_bucket.charge(input_tokens)
+            logger.info(f"Processing request {request_id} of tenant {tenant.name} with {input_tokens} input tokens")
+
+            # Passing the prompt alongside its token IDs keeps it available on the RequestOutput.
+            inputs = {"prompt": prompt, "prompt_token_ids": input_token_ids}
+            generation = self.start_generation(
+                inputs, sampling_params, request_id, coalesce_key, tenant, cost, lora_request
+            )
+        results_generator = generation.subscribe()
+        results_generator.watch(receive, deadline - time.monotonic() if deadline is not None else None)
 
         if stream:
-            background_tasks = BackgroundTasks()
-            # Using background_tasks to abort the request
-            # if the client disconnects.
-            background_tasks.add_task(self.may_abort_request, request_id)
             return StreamingResponse(
-                self.stream_results(results_generator), background=background_tasks
+                self.stream_results(results_generator, delta, encoding, cache_key),
+                media_type=encoding,
             )
 
-        # Non-streaming case
+        # Non-streaming case. The cancellation watcher ends the iteration early if the client
+        # disconnects or the request times out.
         final_output = None
-        async for request_output in results_generator:
-            if await request.is_disconnected():
-                # Abort the request if the client disconnects.
-                await self.engine.abort(request_id)
-                logger.warning(f"Client disconnected for request {request_id}")
-                return Response(status_code=499)
-            final_output = request_output
+        try:
+            async for request_output in results_generator:
+                final_output = request_output
+        finally:
+            await results_generator.aclose()
+
+        if results_generator.cancel_reason == "disconnect":
+            logger.warning(f"Client disconnected for request {request_id}")
+            return Response(status_code=499)
+        if results_generator.cancel_reason == "deadline" and final_output is None:
+            return JSONResponse(status_code=504, content={"error": "Request timed out"})
 
         assert final_output is not None
+        output = final_output.outputs[0]
+        if cache_key is not None and output.finish_reason in ("stop", "length"):
+            await self.cache_put(
+                cache_key, output.text, output.token_ids, output.finish_reason, len(final_output.prompt_token_ids)
+            )
         prompt = final_output.prompt
         text_outputs = [prompt + output.text for output in final_output.outputs]
         ret = {"text": text_outputs}
+        if results_generator.cancel_reason == "deadline":
+            # The deadline passed mid-generation: return what was generated so far.
+            ret["finish_reason"] = "deadline"
+        if encoding == MSGPACK:
+            ret["token_ids"] = list(output.token_ids)
+            ret["usage"] = {"prompt_tokens": len(final_output.prompt_token_ids), "completion_tokens": len(output.token_ids)}
         logger.info(f"Completed request {request_id}")
-        return Response(content=json.dumps(ret))
+        return encode_response(ret, encoding)
+
+
+@serve.deployment(name="vllm-router", route_prefix=ROUTE_PREFIX,
+    ray_actor_options={"num_cpus": 1},
+    autoscaling_config={"min_replicas": 1, "max_replicas": 2},
+)
+class VLLMRouter:
+    """
+    Ingress in front of one or more VLLMDeployment pools keyed by their max_model_len.
+
+    The prompt is tokenized here. With several pools the request goes to the smallest pool whose
+    max_model_len fits prompt + max_tokens. The token IDs are forwarded so the replica does not
+    tokenize again, except for adapter requests. Within a pool, prefix buckets are routed as multiplexed model IDs, so
+    Serve prefers a replica that already holds the prompt prefix in its prefix cache and falls
+    back to a less loaded one when those replicas are at capacity. Requests for a LoRA adapter are
+    routed the same way on the adapter name instead. A replica shedding load
+    (503) is spilled over once to whichever replica Serve picks without affinity.
+    Batch items are routed to pools one by one, like single requests.
+    """
+
+    def __init__(self, pools: Dict[int, DeploymentHandle]):
+        self.pools = {max_model_len: handle.options(stream=True) for max_model_len, handle in sorted(pools.items())}
+        # Prefix buckets are hashed over tokens, so the router tokenizes even with a single pool.
+        self.tokenizer = load_tokenizer(os.getenv("MODEL_ID", "mistralai/Mistral-7B-Instruct-v0.2"))
+        self.tokenizer_executor = ThreadPoolExecutor(max_workers=4)
+
+    async def select_pool(self, request_dict: dict) -> Tuple[DeploymentHandle, Optional[List[int]]]:
+        """
+        The pool to serve the request and the prompt's token IDs to forward to it. Requests for a
+        LoRA adapter get no token IDs: adapters may add tokens, so the replica tokenizes those with
+        the adapter's tokenizer.
+        """
+        prompt_token_ids = await asyncio.get_running_loop().run_in_executor(
+            self.tokenizer_executor, self.tokenizer.encode, request_dict.get("prompt", "")
+        )
+        context_length = request_dict.get("context_length", 8192)
+        required = min(len(prompt_token_ids) + request_dict.get("max_tokens", 8192), context_length)
+        handle = next((handle for max_model_len, handle in self.pools.items() if required <= max_model_len), None)
+        if handle is None:
+            handle = next(reversed(self.pools.values()))
+        return handle, None if request_dict.get("adapter") else prompt_token_ids
+
+    async def route_batch(self, items: list, headers: dict) -> AsyncGenerator[bytes, None]:
+        """
+        Send every batch item to the pool select_pool picks for it, so short items fill the
+        engine batches of the small pools, and merge the pools' NDJSON streams as lines arrive.
+        """
+        routed = await asyncio.gather(*(self.select_pool(item) for item in items), return_exceptions=True)
+        groups = {}  # pool handle ID -> (handle, indices, items, token IDs)
+        for index, (item, route) in enumerate(zip(items, routed)):
+            if isinstance(route, Exception):
+                # Items that cannot be routed fail on their own, like any other invalid item.
+                error = {"index": index, "status_code": 400, "error": f"Invalid request: {route}"}
+                yield (json.dumps(error) + "\n").encode("utf-8")
+                continue
+            handle, prompt_token_ids = route
+            group = groups.setdefault(id(handle), (handle, [], [], []))
+            group[1].append(index)
+            group[2].append(item)
+            group[3].append(prompt_token_ids)
+
+        streams = [
+            handle.generate_batch.remote(group_items, headers, indices, prompt_token_ids)
+            for handle, indices, group_items, prompt_token_ids in groups.values()
+        ]
+        lines = asyncio.Queue()
+
+        async def forward(stream) -> None:
+            try:
+                async for line in stream:
+                    await lines.put(line)
+                await lines.put(None)
+            except Exception as e:
+                await lines.put(e)
+
+        tasks = [asyncio.create_task(forward(stream)) for stream in streams]
+        try:
+            for _ in tasks:
+                while (line := await lines.get()) is not None:
+                    if isinstance(line, Exception):
+                        raise line
+                    yield line
+        finally:
+            for task in tasks:
+                task.cancel()
+            for stream in streams:
+                stream.cancel()
+
+    async def __call__(self, request: Request) -> Response:
+        headers = dict(request.headers)
+        if is_batch_request(request):
+            try:
+                items = parse_batch(await request.body())
+            except ValueError as e:
+                return JSONResponse(status_code=400, content={"error": f"Invalid batch: {e}"})
+            return StreamingResponse(self.route_batch(items, headers), media_type="application/x-ndjson")
+
+        try:
+            request_dict = await request.json()
+        except json.JSONDecodeError:
+            return JSONResponse(status_code=400, content={"error": "Invalid JSON in request body"})
+
+        handle, prompt_token_ids = await self.select_pool(request_dict)
+        # Adapter requests go where the adapter is already loaded; the prefix matters less.
+        adapter = request_dict.get("adapter")
+        affinity_key = adapter_affinity_key(adapter) if adapter else prefix_bucket(prompt_token_ids)
+        stream = handle.options(multiplexed_model_id=affinity_key).generate.remote(
+            request_dict, headers, prompt_token_ids
+        )
+        head = await stream.__anext__()
+        if head["status_code"] == 503:
+            stream.cancel()
+            stream = handle.generate.remote(request_dict, headers, prompt_token_ids)
+            head = await stream.__anext__()
+
+        return StreamingResponse(
+            stream, status_code=head["status_code"], headers=head["headers"], media_type=head["media_type"]
+        )
+
+
+class MultiplexedModel:
+    """
+    An engine loaded by MultiModelDeployment. Serve calls __del__ from a worker thread when it
+    evicts the model; that waits for the model's in-flight requests to finish and then frees the
+    engine's GPU memory before the next model is loaded in its place.
+    """
+
+    def __init__(self, model_id: str, engine: AsyncLLMEngine, on_retire: Callable[[str], None]):
+        self.model_id = model_id
+        self.engine = engine
+        self.on_retire = on_retire
+        self.active = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+
+    def acquire(self) -> None:
+        self.active += 1
+        self.idle.clear()
+
+    def release(self) -> None:
+        self.active -= 1
+        if self.active == 0:
+            self.idle.set()
+
+    async def retire(self) -> None:
+        await self.idle.wait()
+        background_loop = getattr(self.engine, "_background_loop_unshielded", None)
+        if background_loop is not None:
+            background_loop.cancel()
+        self.engine = None
+        gc.collect()
+        import torch
+
+        torch.cuda.empty_cache()
+        self.on_retire(self.model_id)
+        logger.info(f"Unloaded model {self.model_id}")
+
+    def __del__(self):
+        # Only an eviction by Serve arrives here from another thread while the loop is running.
+        if self.engine is None or threading.get_ident() == self.loop_thread or not self.loop.is_running():
+            return
+        asyncio.run_coroutine_threadsafe(self.retire(), self.loop).result()
+
+
+@serve.deployment(name="multiplexed-deployment", route_prefix=ROUTE_PREFIX,
+    ray_actor_options={"num_gpus": 1},
+    autoscaling_config={"min_replicas": 1, "max_replicas": 2},
+)
+class MultiModelDeployment:
+    """
+    Serves every model in MULTIPLEX_MODELS from one replica pool. A request names its model in
+    the serve_multiplexed_model_id header; Serve routes it to a replica where that model is
+    resident when there is one, and otherwise the replica loads it, evicting its least recently
+    used model when it is full. Low-traffic models then share GPUs instead of pinning them.
+    """
+
+    def __init__(self):
+        if not WEIGHTS_DIR and os.getenv("HUGGING_FACE_HUB_TOKEN"):
+            login(token=os.getenv("HUGGING_FACE_HUB_TOKEN"))
+        tag_keys = ("model",)
+        self.requests = metrics.Counter(
+            "vllm_serve_multiplexed_requests_total", description="Requests per multiplexed model.", tag_keys=tag_keys,
+        )
+        self.loads = metrics.Counter(
+            "vllm_serve_multiplexed_loads_total",
+            description="Requests that had to load their model on the replica (1 - loads/requests is the hit rate).",
+            tag_keys=tag_keys,
+        )
+        self.evictions = metrics.Counter(
+            "vllm_serve_multiplexed_evictions_total", description="Models evicted from a replica.", tag_keys=tag_keys,
+        )
+        self.load_time = metrics.Histogram(
+            "vllm_serve_multiplexed_load_seconds",
+            description="Time to stage and load a model into a new engine.",
+            boundaries=[1, 5, 10, 20, 30, 60, 120, 300, 600],
+            tag_keys=tag_keys,
+        )
+        self.resident = 0
+        self.load_lock = asyncio.Lock()
+
+    def on_retire(self, model_id: str) -> None:
+        self.resident -= 1
+        self.evictions.inc(tags={"model": model_id})
+
+    @serve.multiplexed(max_num_models_per_replica=MULTIPLEX_MODELS_PER_REPLICA)
+    async def get_model(self, model_id: str) -> MultiplexedModel:
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        model = model_id
+        if WEIGHTS_DIR:
+            model, _ = await loop.run_in_executor(
+                None, stage_weights, model_id, WEIGHTS_DIR, MODEL_REVISION, os.getenv("HUGGING_FACE_HUB_TOKEN")
+            )
+        kwargs = engine_kwargs(model=model)
+        async with self.load_lock:
+            # Resident engines split the memory a single engine would otherwise use. vLLM sizes the
+            # KV cache against everything in use on the GPU, including the other engines, so the
+            # limit handed to each new engine is cumulative.
+            kwargs["gpu_memory_utilization"] *= (self.resident + 1) / MULTIPLEX_MODELS_PER_REPLICA
+            args = AsyncEngineArgs(**kwargs, disable_log_requests=True)
+            # Building the engine takes a while; keep serving the other resident models meanwhile.
+            engine = await loop.run_in_executor(None, AsyncLLMEngine.from_engine_args, args)
+            self.resident += 1
+        self.loads.inc(tags={"model": model_id})
+        self.load_time.observe(time.monotonic() - start, tags={"model": model_id})
+        logger.info(f"Loaded model {model_id} in {time.monotonic() - start:.1f}s")
+        return MultiplexedModel(model_id, engine, self.on_retire)
+
+    async def acquire_model(self, model_id: str) -> MultiplexedModel:
+        """
+        The resident model, held against eviction until release() is called. Nothing is awaited
+        between the lookup and acquire(), so an eviction cannot free the engine in between.
+        """
+        while True:
+            model = await self.get_model(model_id)
+            if model.engine is not None:
+                model.acquire()
+                return model
+
+    async def stream_text(self, model_id: str, prompt: str, sampling_params: SamplingParams, request_id: str,
+                          encoding: Optional[str]) -> AsyncGenerator[bytes, None]:
+        # The model is held only once the body is iterated: a response whose body never starts,
+        # e.g. after an early client disconnect, must not keep it from being evicted.
+        model = await self.acquire_model(model_id)
+        num_chars = 0
+        try:
+            # generate aborts the engine request when the stream is closed, e.g. on client disconnect.
+            results_generator = model.engine.generate(prompt, sampling_params, request_id)
+            async for request_output in results_generator:
+                text = request_output.outputs[0].text
+                if len(text) > num_chars:
+                    yield encode_chunk({"text": text[num_chars:]}, encoding)
+                    num_chars = len(text)
+            if encoding == SSE:
+                yield b"data: [DONE]\n\n"
+        finally:
+            model.release()
+
+    async def __call__(self, request: Request) -> Response:
+        model_id = serve.get_multiplexed_model_id()
+        if not model_id:
+            return JSONResponse(status_code=400, content={"error": "Missing serve_multiplexed_model_id header"})
+        if model_id not in MULTIPLEX_MODELS:
+            return JSONResponse(status_code=404, content={"error": f"Unknown model: {model_id}"})
+        try:
+            request_dict = await request.json()
+        except json.JSONDecodeError:
+            return JSONResponse(status_code=400, content={"error": "Invalid JSON in request body"})
+
+        self.requests.inc(tags={"model": model_id})
+        # Load the model before the response starts, so a failed load is still answered as an error.
+        await self.get_model(model_id)
+        prompt = request_dict.pop("prompt")
+        stream = request_dict.pop("stream", False)
+        encoding = response_encoding(request.headers)
+        sampling_params = SamplingParams(
+            max_tokens=request_dict.get("max_tokens", 512),
+            temperature=request_dict.get("temperature", 0.7),
+            top_p=request_dict.get("top_p", 0.9),
+            top_k=request_dict.get("top_k", 50),
+            stop=request_dict.get("stop", None),
+        )
+        request_id = random_uuid()
+        if stream:
+            return StreamingResponse(
+                self.stream_text(model_id, prompt, sampling_params, request_id, encoding), media_type=encoding
+            )
+
+        # Holding the model keeps an eviction from freeing its engine under this request.
+        model = await self.acquire_model(model_id)
+        final_output = None
+        try:
+            # generate aborts the engine request when this request is cancelled, e.g. on client disconnect.
+            async for request_output in model.engine.generate(prompt, sampling_params, request_id):
+                final_output = request_output
+        finally:
+            model.release()
+        return encode_response({"text": [prompt + output.text for output in final_output.outputs]}, encoding)
 
 
 deployment = VLLMDeployment.bind()
+
+# Prefix-affinity routing in front of the same deployment: import_path "vllm_serve:router".
+router = VLLMRouter.bind({
+    int(os.getenv("MAX_MODEL_LEN", "4096")): VLLMDeployment.options(route_prefix=None).bind(),
+})
+
+# One deployment per context-length pool behind the router: import_path "vllm_serve:pooled_router".
+pooled_router = VLLMRouter.bind({
+    pool["max_model_len"]: VLLMDeployment.options(
+        name=f"mistral-deployment-{pool['max_model_len']}", route_prefix=None
+    ).bind(**pool)
+    for pool in CONTEXT_POOLS
+})
+
+# Several models sharing one replica pool: import_path "vllm_serve:multiplexed_deployment".
+multiplexed_deployment = MultiModelDeployment.bind()
@@ -0,0 +1,144 @@
+"""
+Stage model weights on node-local NVMe (or a shared filesystem) for fast replica cold starts.
+
+The first replica on a node downloads the model's safetensors, config and tokenizer files from
+the Hugging Face Hub into WEIGHTS_DIR and writes a manifest with the size and SHA-256 of every
+file. Later replicas find the manifest, check the files against it and hand vLLM the local path,
+so they start without network access or a Hub login. vLLM memory-maps safetensors, so only the
+pages it touches are read from disk.
+
+Weights can also be staged ahead of time, for example from an init container or a node bootstrap
+job:
+
+    python weight_staging.py --model mistralai/Mistral-7B-Instruct-v0.2 --weights-dir /mnt/k8s-disks/0/models
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from typing import Dict, Tuple
+
+logger = logging.getLogger("ray.serve")
+
+MANIFEST = "manifest.json"
+
+# Only the files vLLM needs to serve from safetensors; PyTorch .bin/.pt duplicates are skipped.
+STAGED_PATTERNS = ["*.safetensors", "*.safetensors.index.json", "*.json", "tokenizer*", "*.model", "*.tiktoken", "*.txt"]
+
+# "size" checks staged files against the manifest's sizes; "checksum" re-hashes them on every load.
+WEIGHTS_VERIFY = os.getenv("WEIGHTS_VERIFY", "size")
+
+
+class StagingError(Exception):
+    pass
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_manifest(path: str, model_id: str, revision: str) -> dict:
+    files = {}
+    for root, _, names in os.walk(path):
+        for name in names:
+            file_path = os.path.join(root, name)
+            relative = os.path.relpath(file_path, path)
+            if relative == MANIFEST or relative.startswith(".cache"):
+                continue
+            files[relative] = {"size": os.path.getsize(file_path), "sha256": file_digest(file_path)}
+    manifest = {"model_id": model_id, "revision": revision, "files": files}
+    with open(os.path.join(path, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def verify(path: str, checksum: bool) -> bool:
+    """True if every file in the staged directory's manifest is present and intact."""
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    for relative, expected in manifest["files"].items():
+        file_path = os.path.join(path, relative)
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) != expected["size"]:
+            logger.warning(f"Staged weights in {path} are incomplete: {relative}")
+            return False
+        if checksum and file_digest(file_path) != expected["sha256"]:
+            logger.warning(f"Staged weights in {path} are corrupt: {relative}")
+            return False
+    return True
+
+
+def staged_path(model_id: str, weights_dir: str, revision: str = "main") -> str:
+    """Where stage_weights puts a model's files."""
+    return os.path.join(weights_dir, model_id.replace("/", "--"), revision)
+
+
+def stage_weights(model_id: str, weights_dir: str, revision: str = "main",
+                  token: str = None) -> Tuple[str, Dict[str, float]]:
+    """
+    Return the local path of the staged model and the time spent per staging phase, downloading
+    the weights first if they are missing or fail verification. Replicas starting together on
+    one node serialize on a file lock, so only one of them downloads.
+    """
+    path = staged_path(model_id, weights_dir, revision)
+    timings = {}
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lock = open(f"{path}.lock", "w")
+    except PermissionError as e:
+        raise StagingError(f"{weights_dir} is not writable by uid {os.getuid()}: {e}") from e
+    with lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            start = time.monotonic()
+            if verify(path, checksum=WEIGHTS_VERIFY == "checksum"):
+                timings["verify"] = time.monotonic() - start
+                return path, timings
+
+            from huggingface_hub import snapshot_download
+
+            staging = f"{path}.partial"
+            shutil.rmtree(path, ignore_errors=True)
+            start = time.monotonic()
+            snapshot_download(
+                model_id, revision=revision, local_dir=staging, allow_patterns=STAGED_PATTERNS, token=token,
+            )
+            if not any(name.endswith(".safetensors") for name in os.listdir(staging)):
+                raise StagingError(f"{model_id} has no safetensors weights to stage")
+            timings["download"] = time.monotonic() - start
+
+            start = time.monotonic()
+            write_manifest(staging, model_id, revision)
+            # The manifest goes in before the rename, so a staged directory is always complete.
+            os.rename(staging, path)
+            timings["verify"] = time.monotonic() - start
+            logger.info(f"Staged {model_id} in {path}")
+            return path, timings
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stage model weights for vLLM replicas")
+    parser.add_argument("--model", default=os.getenv("MODEL_ID", "mistralai/Mistral-7B-Instruct-v0.2"))
+    parser.add_argument("--revision", default=os.getenv("MODEL_REVISION", "main"))
+    parser.add_argument("--weights-dir", default=os.getenv("WEIGHTS_DIR", "/mnt/k8s-disks/0/models"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    path, timings = stage_weights(args.model, args.weights_dir, args.revision, os.getenv("HUGGING_FACE_HUB_TOKEN"))
+    print(json.dumps({"path": path, "timings": timings}))
+
+
+if __name__ == "__main__":
+    main()